@@ -0,0 +1,158 @@
+"""
+Synthetic catalog for the benchmarks. Scale 1 is about the size of SWAPI (60
+planets, 90 people, 40 vehicles) with 1000 users, every table grows linearly
+with the scale. Favorites follow a Zipf distribution, a few characters,
+planets and vehicles are favorited by most users and the long tail by almost
+nobody, and the number of favorites per user is geometric. The same seed
+always gives the same catalog.
+"""
+import random
+from models import db, User, Person, Planet, Vehicle, favorite_people, favorite_planets, favorite_vehicles, parse_number
+import versions
+
+# rows of each table at scale 1
+BASE = {"planets": 60, "people": 90, "vehicles": 40, "users": 1000}
+
+# average favorites per user, (model, junction table, junction column)
+FAVORITES = {
+    "people": (5, Person, favorite_people, "person_id"),
+    "planets": (3, Planet, favorite_planets, "planet_id"),
+    "vehicles": (2, Vehicle, favorite_vehicles, "vehicle_id"),
+}
+
+ZIPF_EXPONENT = 1.1
+
+WORDS = [
+    "desert", "ocean", "forest", "ice", "swamp", "city", "jedi", "sith", "smuggler",
+    "pilot", "droid", "senator", "rebel", "empire", "bounty", "hunter", "speeder",
+    "walker", "cloud", "mining", "farm", "moon", "outer", "rim", "core", "trade",
+]
+
+CHUNK_SIZE = 1000
+
+
+def counts(scale):
+    return {table: max(1, int(count * scale)) for table, count in BASE.items()}
+
+
+def number(rng, low, high, unknown=0.1):
+    # SWAPI values are strings, some unknown and some with thousands separators
+    if rng.random() < unknown:
+        return "unknown"
+    value = rng.randint(low, high)
+    return "{:,}".format(value) if value >= 1000 and rng.random() < 0.3 else str(value)
+
+
+def description(rng):
+    return " ".join(rng.choice(WORDS) for i in range(rng.randint(5, 20)))
+
+
+def with_values(model, row):
+    for name in model.numeric_fields:
+        row[name + "_value"] = parse_number(row[name])
+    return row
+
+
+def insert(model_or_table, rows):
+    table = getattr(model_or_table, "__table__", model_or_table)
+    for start in range(0, len(rows), CHUNK_SIZE):
+        db.session.execute(table.insert(), rows[start:start + CHUNK_SIZE])
+
+
+def zipf_weights(count):
+    weights = []
+    total = 0
+    for rank in range(1, count + 1):
+        total += 1 / rank ** ZIPF_EXPONENT
+        weights.append(total)
+    return weights
+
+
+def generate(scale=1, seed=42):
+    """
+    Fills the empty tables of the current app, returns the number of rows of
+    each table
+    """
+    rng = random.Random(seed)
+    sizes = counts(scale)
+
+    insert(Planet, [with_values(Planet, {
+        "id": i,
+        "name": "Planet %d" % i,
+        "diameter": number(rng, 1000, 200000),
+        "rotation_period": number(rng, 10, 60),
+        "orbital_period": number(rng, 100, 5000),
+        "gravity": "%s standard" % rng.choice(["0.5", "1", "1.5", "2"]),
+        "population": number(rng, 0, 10 ** 12, unknown=0.25),
+        "climate": rng.choice(["arid", "temperate", "frozen", "murky", "tropical"]),
+        "terrain": rng.choice(["desert", "grasslands", "mountains", "jungle", "ocean"]),
+        "surface_water": number(rng, 0, 100),
+        "description": description(rng),
+        "photo_url": "https://example.com/planets/%d.jpg" % i,
+    }) for i in range(1, sizes["planets"] + 1)])
+
+    insert(Person, [with_values(Person, {
+        "id": i,
+        "name": "Person %d" % i,
+        "height": number(rng, 60, 260),
+        "mass": number(rng, 15, 1400),
+        "hair_color": rng.choice(["blond", "brown", "black", "none", "white"]),
+        "skin_color": rng.choice(["fair", "gold", "white", "green", "dark"]),
+        "eye_color": rng.choice(["blue", "yellow", "red", "brown", "black"]),
+        "birth_year": "%dBBY" % rng.randint(1, 900),
+        "gender": rng.choice(["male", "female", "n/a"]),
+        "homeworld_id": rng.randint(1, sizes["planets"]),
+        "description": description(rng),
+        "photo_url": "https://example.com/people/%d.jpg" % i,
+    }) for i in range(1, sizes["people"] + 1)])
+
+    insert(Vehicle, [with_values(Vehicle, {
+        "id": i,
+        "name": "Vehicle %d" % i,
+        "model": "Model %d" % rng.randint(1, 50),
+        "vehicle_class": rng.choice(["wheeled", "repulsorcraft", "starfighter", "walker"]),
+        "manufacturer": rng.choice(["Corellia Mining Corporation", "Incom Corporation", "Kuat Drive Yards"]),
+        "cost_in_credits": number(rng, 1000, 10 ** 7),
+        "length": number(rng, 1, 100),
+        "crew": number(rng, 1, 50),
+        "passengers": number(rng, 0, 100),
+        "max_atmosphering_speed": number(rng, 100, 2000),
+        "cargo_capacity": number(rng, 0, 10 ** 6),
+        "consumables": rng.choice(["none", "1 day", "2 months", "1 year"]),
+        "description": description(rng),
+        "photo_url": "https://example.com/vehicles/%d.jpg" % i,
+    }) for i in range(1, sizes["vehicles"] + 1)])
+
+    insert(User, [{
+        "id": i,
+        "name": "User %d" % i,
+        "username": "user%d" % i,
+        "email": "user%d@example.com" % i,
+        "password": "password",
+        "is_active": True,
+    } for i in range(1, sizes["users"] + 1)])
+
+    for table, (average, model, junction, column) in FAVORITES.items():
+        ids = list(range(1, sizes[table] + 1))
+        weights = zipf_weights(sizes[table])
+        rows = []
+        for user_id in range(1, sizes["users"] + 1):
+            # geometric number of favorites with the given average
+            count = 0
+            while rng.random() < average / (average + 1) and count < len(ids):
+                count += 1
+            chosen = set(rng.choices(ids, cum_weights=weights, k=count))
+            rows += [{"user_id": user_id, column: id} for id in sorted(chosen)]
+        insert(junction, rows)
+
+        counted = (
+            db.select(db.func.count())
+            .select_from(junction)
+            .where(junction.c[column] == model.__table__.c.id)
+            .scalar_subquery()
+        )
+        db.session.execute(model.__table__.update().values(favorite_count=counted))
+
+    versions.bump(db.session.connection(), {"users", "people", "planets", "vehicles"})
+    db.session.commit()
+    return sizes
@@ -0,0 +1,261 @@
+"""
+Benchmarks every route of src/main.py in-process with the Flask test client,
+against a synthetic catalog (see dataset.py):
+
+    $ pipenv run python benchmarks/run.py
+    $ pipenv run python benchmarks/run.py --scale 10 --requests 500
+    $ pipenv run python benchmarks/run.py --database postgresql://localhost/bench
+    $ pipenv run python benchmarks/run.py --save
+
+The database is emptied and filled again on every run, by default it is a
+sqlite file in the temporary directory. Each route reports its p50 and p99
+latency, its throughput and the SQL statements per request. The results are
+compared with benchmarks/baseline.json (same scale, database, requests and
+warmup only): a route whose p50 or p99 grew by more than --threshold, or that
+runs more statements, is flagged and the exit status is 1. --save stores the
+results as the new baseline.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+sys.path.insert(0, HERE)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks the routes of the API")
+    parser.add_argument("--scale", type=float, default=1, help="size of the synthetic catalog (default 1)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--database", help="database url, emptied before the run (default: a temporary sqlite file)")
+    parser.add_argument("--requests", type=int, default=100, help="measured requests per route (default 100)")
+    parser.add_argument("--warmup", type=int, default=10, help="requests per route before measuring (default 10)")
+    parser.add_argument("--routes", help="comma separated names of the routes to run (default: all)")
+    parser.add_argument("--baseline", default=os.path.join(HERE, "baseline.json"))
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown before flagging, 0.25 is 25%%")
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--output", help="also write the results to this file")
+    return parser.parse_args()
+
+
+def scenarios(sizes, rng, token):
+    """
+    (name, method, path, json body, headers) of every route, the path, the
+    body and the headers are functions so each request picks other rows. The
+    writes come last. token(i) returns a JWT of the i-th user.
+    """
+    def person():
+        return rng.randint(1, sizes["people"])
+
+    def planet():
+        return rng.randint(1, sizes["planets"])
+
+    def vehicle():
+        return rng.randint(1, sizes["vehicles"])
+
+    def user():
+        return rng.randint(1, sizes["users"])
+
+    def bearer():
+        return {"Authorization": "Bearer " + token(user())}
+
+    def operations():
+        types = [("person", person), ("planet", planet), ("vehicle", vehicle)]
+        result = []
+        for i in range(10):
+            type_name, pick = rng.choice(types)
+            result.append({"op": rng.choice(["add", "remove"]), "type": type_name, "id": pick()})
+        return {"operations": result}
+
+    return [
+        ("sitemap", "GET", lambda: "/", None, None),
+        ("users", "GET", lambda: "/users", None, None),
+        ("users_page", "GET", lambda: "/users?limit=50", None, None),
+        ("users_ids", "GET", lambda: "/users?favorites=ids&limit=50", None, None),
+        ("users_export", "GET", lambda: "/users/export", None, None),
+        ("user", "GET", lambda: "/users/%d" % user(), None, None),
+        ("people", "GET", lambda: "/people", None, None),
+        ("people_sorted", "GET", lambda: "/people?sort=-mass&mass_gte=50&limit=20", None, None),
+        ("people_fields", "GET", lambda: "/people?fields=name,homeworld&limit=50", None, None),
+        ("people_export", "GET", lambda: "/people/export", None, None),
+        ("people_popular", "GET", lambda: "/people/popular", None, None),
+        ("person", "GET", lambda: "/people/%d" % person(), None, None),
+        ("planets", "GET", lambda: "/planets", None, None),
+        ("planets_export", "GET", lambda: "/planets/export", None, None),
+        ("planets_popular", "GET", lambda: "/planets/popular", None, None),
+        ("planet", "GET", lambda: "/planets/%d" % planet(), None, None),
+        ("vehicles", "GET", lambda: "/vehicles", None, None),
+        ("vehicles_export", "GET", lambda: "/vehicles/export", None, None),
+        ("vehicles_popular", "GET", lambda: "/vehicles/popular", None, None),
+        ("vehicle", "GET", lambda: "/vehicles/%d" % vehicle(), None, None),
+        ("search", "GET", lambda: "/search?q=" + rng.choice(["jedi", "desert moon", "bounty hunter", "rebel pilot"]), None, None),
+        ("people_ids", "GET", lambda: "/people?ids=" + ",".join(str(person()) for i in range(20)), None, None),
+        ("batch", "POST", lambda: "/batch", lambda: {"requests": ["/people/%d" % person() for i in range(10)] + ["/planets/%d" % planet() for i in range(5)] + ["/vehicles?limit=5"]}, None),
+        ("changes", "GET", lambda: "/changes?since=0&limit=100", None, None),
+        ("metrics", "GET", lambda: "/metrics", None, None),
+        ("me_favorites", "GET", lambda: "/me/favorites", None, bearer),
+        ("me_favorite", "GET", lambda: "/me/favorites/planet/%d" % planet(), None, bearer),
+        ("login", "POST", lambda: "/login", lambda: {"username": "user%d" % user(), "password": "password"}, None),
+        ("add_favorite", "PUT", lambda: "/users", lambda: {"user_id": user(), "type": "planet", "id": planet()}, None),
+        ("bulk_favorites", "POST", lambda: "/users/%d/favorites" % user(), operations, None),
+        ("me_add_favorite", "PUT", lambda: "/me/favorites/planet/%d" % planet(), None, bearer),
+        ("me_bulk_favorites", "POST", lambda: "/me/favorites", operations, bearer),
+    ]
+
+
+def percentile(values, p):
+    # nearest rank on the sorted values
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def measure(client, counter, method, path, body, headers, requests, warmup):
+    for i in range(warmup):
+        client.open(path(), method=method, json=body() if body else None, headers=headers() if headers else None).get_data()
+    latencies = []
+    statements = 0
+    start = time.perf_counter()
+    for i in range(requests):
+        url, data, extra = path(), body() if body else None, headers() if headers else None
+        before = counter["statements"]
+        request_start = time.perf_counter()
+        response = client.open(url, method=method, json=data, headers=extra)
+        response.get_data()
+        latencies.append(time.perf_counter() - request_start)
+        statements += counter["statements"] - before
+        if response.status_code >= 400:
+            raise RuntimeError("%s %s answered %d" % (method, url, response.status_code))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "rps": round(requests / elapsed, 1),
+        "queries": round(statements / requests, 2),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns the regressions of results against the baseline as messages
+    """
+    regressions = []
+    for name, current in results["routes"].items():
+        previous = baseline["routes"].get(name)
+        if previous is None:
+            continue
+        for key in ("p50_ms", "p99_ms"):
+            if current[key] > previous[key] * (1 + threshold):
+                regressions.append("%s: %s %.3f -> %.3f (+%.0f%%)" % (
+                    name, key, previous[key], current[key], (current[key] / previous[key] - 1) * 100
+                ))
+        if current["queries"] > previous["queries"]:
+            regressions.append("%s: queries %.2f -> %.2f" % (name, previous["queries"], current["queries"]))
+    return regressions
+
+
+def main():
+    args = parse_args()
+    database = args.database
+    if database is None:
+        path = os.path.join(tempfile.gettempdir(), "starwars-api-bench.db")
+        if os.path.exists(path):
+            os.remove(path)
+        database = "sqlite:///" + path
+    os.environ["DB_CONNECTION_STRING"] = database
+    # the snapshot and the slow log would measure something else
+    os.environ.pop("SNAPSHOT_PATH", None)
+    os.environ["SLOW_REQUEST_MS"] = "0"
+
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from flask_jwt_extended import create_access_token
+    from main import app
+    from models import db
+    import dataset
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        sizes = dataset.generate(args.scale, args.seed)
+        dialect = db.engine.dialect.name
+
+    counter = {"statements": 0}
+
+    def count(*args):
+        counter["statements"] += 1
+
+    event.listen(Engine, "before_cursor_execute", count)
+
+    tokens = {}
+
+    def token(i):
+        # created once per user, outside of the measured requests
+        if i not in tokens:
+            with app.app_context():
+                tokens[i] = create_access_token(identity="user%d" % i)
+        return tokens[i]
+
+    rng = random.Random(args.seed)
+    selected = set(args.routes.split(",")) if args.routes else None
+    client = app.test_client()
+    results = {
+        "meta": {
+            "scale": args.scale,
+            "database": dialect,
+            "rows": sizes,
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "python": platform.python_version(),
+        },
+        "routes": {},
+    }
+    print("%-18s %10s %10s %10s %8s" % ("route", "p50 ms", "p99 ms", "req/s", "queries"))
+    for name, method, path, body, headers in scenarios(sizes, rng, token):
+        if selected is not None and name not in selected:
+            continue
+        # every route draws the same rows whichever routes run before it
+        rng.seed("%d:%s" % (args.seed, name))
+        result = measure(client, counter, method, path, body, headers, args.requests, args.warmup)
+        results["routes"][name] = result
+        print("%-18s %10.3f %10.3f %10.1f %8.2f" % (name, result["p50_ms"], result["p99_ms"], result["rps"], result["queries"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    status = 0
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        # the statements per request depend on how many requests warmed the
+        # caches, the runs are only comparable with the same counts
+        same = all(baseline["meta"].get(key) == results["meta"][key] for key in ("scale", "database", "requests", "warmup"))
+        if not same:
+            print("\nThe baseline was recorded with another scale, database, requests or warmup, not compared")
+        else:
+            regressions = compare(results, baseline, args.threshold)
+            if regressions:
+                print("\nRegressions against %s:" % args.baseline)
+                for message in regressions:
+                    print("  " + message)
+                status = 1
+            else:
+                print("\nNo regression against %s" % args.baseline)
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+        print("\nBaseline saved to " + args.baseline)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,32 @@
+"""
+gunicorn settings, read from the directory gunicorn is started in (see the
+Procfile).
+
+With GUNICORN_PRELOAD (on by default) the app is loaded once by the master and
+the workers are forked from it: they start without importing anything and
+share the master's memory pages until they write to them.
+"""
+import gc
+import os
+
+preload_app = os.environ.get("GUNICORN_PRELOAD", "true") == "true"
+
+
+def when_ready(server):
+    # the objects of the loaded app are moved out of the garbage collector's
+    # reach, otherwise every collection in a worker touches their headers and
+    # copies the shared pages into the worker
+    if preload_app:
+        gc.collect()
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    # a database connection opened by the master must not be used by several
+    # workers, each one opens its own
+    if preload_app:
+        from models import db
+        app = server.app.wsgi()
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
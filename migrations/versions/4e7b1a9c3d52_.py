@@ -0,0 +1,44 @@
+"""change log
+
+Revision ID: 4e7b1a9c3d52
+Revises: 9d4c2f5e8a13
+Create Date: 2026-10-18 16:21:09.734518
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4e7b1a9c3d52'
+down_revision = '9d4c2f5e8a13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('change_log',
+    sa.Column('seq', sa.Integer(), nullable=False),
+    sa.Column('table_name', sa.String(length=50), nullable=False),
+    sa.Column('row_id', sa.Integer(), nullable=False),
+    sa.Column('op', sa.String(length=10), nullable=False),
+    sa.Column('changed_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('seq'),
+    sqlite_autoincrement=True
+    )
+    # the writers lock this row before appending to the log, it must exist
+    # before two of them try to create it at once
+    table_versions = sa.table('table_versions',
+    sa.column('name', sa.String),
+    sa.column('version', sa.Integer),
+    sa.column('updated_at', sa.DateTime)
+    )
+    op.bulk_insert(table_versions, [
+        {'name': 'change_log', 'version': 1, 'updated_at': datetime.utcnow()}
+    ])
+
+
+def downgrade():
+    op.execute("DELETE FROM table_versions WHERE name = 'change_log'")
+    op.drop_table('change_log')
@@ -0,0 +1,61 @@
+"""numeric shadow columns
+
+Revision ID: 6b1e0d94a2c7
+Revises: 3f2a9c1d7b40
+Create Date: 2026-10-18 11:40:03.551920
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6b1e0d94a2c7'
+down_revision = '3f2a9c1d7b40'
+branch_labels = None
+depends_on = None
+
+NUMERIC_COLUMNS = {
+    'people': ['height', 'mass'],
+    'planets': ['diameter', 'rotation_period', 'orbital_period', 'population', 'surface_water'],
+    'vehicles': ['cost_in_credits', 'length', 'crew', 'passengers', 'max_atmosphering_speed', 'cargo_capacity'],
+}
+
+
+def parse_number(value):
+    # same rules as models.parse_number, copied so the migration doesn't
+    # depend on the current models
+    if value is None:
+        return None
+    try:
+        return float(str(value).replace(',', '').strip())
+    except ValueError:
+        return None
+
+
+def upgrade():
+    for table, columns in NUMERIC_COLUMNS.items():
+        for column in columns:
+            op.add_column(table, sa.Column(column + '_value', sa.Float(), nullable=True))
+
+    # backfill the new columns from the string ones
+    connection = op.get_bind()
+    for table, columns in NUMERIC_COLUMNS.items():
+        source = sa.table(table, sa.column('id'), *[sa.column(c) for c in columns], *[sa.column(c + '_value') for c in columns])
+        rows = connection.execute(sa.select(source.c.id, *[source.c[c] for c in columns])).fetchall()
+        for row in rows:
+            values = {}
+            for column in columns:
+                values[column + '_value'] = parse_number(row._mapping[column])
+            connection.execute(source.update().where(source.c.id == row.id).values(**values))
+
+    for table, columns in NUMERIC_COLUMNS.items():
+        for column in columns:
+            op.create_index(op.f('ix_%s_%s_value' % (table, column)), table, [column + '_value'], unique=False)
+
+
+def downgrade():
+    for table, columns in NUMERIC_COLUMNS.items():
+        for column in columns:
+            op.drop_index(op.f('ix_%s_%s_value' % (table, column)), table_name=table)
+            op.drop_column(table, column + '_value')
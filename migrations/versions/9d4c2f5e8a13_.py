@@ -0,0 +1,44 @@
+"""favorite counters
+
+Revision ID: 9d4c2f5e8a13
+Revises: 6b1e0d94a2c7
+Create Date: 2026-10-18 13:02:47.190334
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d4c2f5e8a13'
+down_revision = '6b1e0d94a2c7'
+branch_labels = None
+depends_on = None
+
+# favorited table -> (junction table, junction column)
+FAVORITES = {
+    'people': ('user_people', 'person_id'),
+    'planets': ('user_planets', 'planet_id'),
+    'vehicles': ('user_vehicles', 'vehicle_id'),
+}
+
+
+def upgrade():
+    for table, (junction, column) in FAVORITES.items():
+        op.create_index(op.f('ix_%s_%s' % (junction, column)), junction, [column], unique=False)
+        op.add_column(table, sa.Column('favorite_count', sa.Integer(), server_default='0', nullable=False))
+
+    # backfill the counters from the junction tables
+    for table, (junction, column) in FAVORITES.items():
+        op.execute(
+            'UPDATE %s SET favorite_count = (SELECT COUNT(*) FROM %s WHERE %s.%s = %s.id)'
+            % (table, junction, junction, column, table)
+        )
+        op.create_index('ix_%s_favorite_count' % table, table, ['favorite_count', 'id'], unique=False)
+
+
+def downgrade():
+    for table, (junction, column) in FAVORITES.items():
+        op.drop_index('ix_%s_favorite_count' % table, table_name=table)
+        op.drop_column(table, 'favorite_count')
+        op.drop_index(op.f('ix_%s_%s' % (junction, column)), table_name=junction)
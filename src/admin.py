@@ -3,6 +3,15 @@ from flask_admin import Admin
 from models import db, User, Person, Planet, Vehicle
 from flask_admin.contrib.sqla import ModelView
 
+
+class CatalogView(ModelView):
+    def __init__(self, model, session, **kwargs):
+        # the numeric *_value columns are computed from the string columns and
+        # favorite_count is maintained from the favorites
+        self.form_excluded_columns = [name + "_value" for name in model.numeric_fields] + ["favorite_count"]
+        super().__init__(model, session, **kwargs)
+
+
 def setup_admin(app):
     app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
     app.config['FLASK_ADMIN_SWATCH'] = 'cerulean'
@@ -11,9 +20,9 @@ def setup_admin(app):
     
     # Add your models here, for example this is how we add a the User model to the admin
     admin.add_view(ModelView(User, db.session))
-    admin.add_view(ModelView(Person, db.session))
-    admin.add_view(ModelView(Planet, db.session))
-    admin.add_view(ModelView(Vehicle, db.session))
+    admin.add_view(CatalogView(Person, db.session))
+    admin.add_view(CatalogView(Planet, db.session))
+    admin.add_view(CatalogView(Vehicle, db.session))
 
     # You can duplicate that line to add mew models
     # admin.add_view(ModelView(YourModelName, db.session))
\ No newline at end of file
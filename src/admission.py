@@ -0,0 +1,256 @@
+"""
+Admission control shared by all the gunicorn workers of the host, through
+files in ADMISSION_DIR (no external service):
+
+- Concurrency limits: an endpoint runs at most CONCURRENCY_LIMIT requests at
+  once across the workers (CONCURRENCY_LIMITS overrides it per endpoint, like
+  "search=2,export_people=1"). A slot is an flock on one of the endpoint's
+  slot files, released by the kernel if the worker dies. Up to
+  ADMISSION_QUEUE_SIZE more requests wait for a slot, at most
+  ADMISSION_TIMEOUT_MS. The others get a 503 with Retry-After straight away
+  instead of holding a worker until gunicorn's timeout.
+- Rate limits: a token bucket per client of RATE_LIMIT_BURST requests,
+  refilled at RATE_LIMIT_PER_SECOND, kept in a sqlite file. The client is the
+  X-API-Key header when it is one of API_KEYS, else the identity of a valid
+  JWT, else the remote address. A client over its limit gets a 429 with
+  Retry-After.
+"""
+import fcntl
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from flask import current_app, request
+from utils import APIException, jwt_identity
+
+# endpoints that are never limited, the metrics must stay scrapable
+EXEMPT_ENDPOINTS = ("get_metrics",)
+
+
+def parse_limits(value):
+    # "search=2,export_people=1" -> {"search": 2, "export_people": 1}
+    limits = {}
+    for item in (value or "").split(","):
+        if item.strip() == "":
+            continue
+        endpoint, separator, limit = item.partition("=")
+        if separator == "" or not limit.strip().isdigit():
+            raise ValueError("Invalid CONCURRENCY_LIMITS entry " + item)
+        limits[endpoint.strip()] = int(limit)
+    return limits
+
+
+def try_lock(path):
+    # the file descriptor of path locked by this request, None when another
+    # request (of any worker) holds it. A new descriptor is opened every time
+    # so the threads of one worker exclude each other too
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def unlock(fd):
+    # closing the descriptor releases the lock
+    os.close(fd)
+
+
+class Overloaded(Exception):
+    pass
+
+
+class Slots:
+    """
+    Concurrency limit of one endpoint: limit slot files and queue_size wait
+    files in directory
+    """
+    def __init__(self, directory, endpoint, limit, queue_size):
+        self.run_paths = [os.path.join(directory, "%s.run.%d" % (endpoint, i)) for i in range(limit)]
+        self.wait_paths = [os.path.join(directory, "%s.wait.%d" % (endpoint, i)) for i in range(queue_size)]
+
+    def try_acquire(self, paths):
+        for path in paths:
+            fd = try_lock(path)
+            if fd is not None:
+                return fd
+        return None
+
+    def acquire(self, timeout):
+        """
+        Returns the locked slot, waits for one at most timeout seconds, raises
+        Overloaded when the queue is full or the time is up
+        """
+        fd = self.try_acquire(self.run_paths)
+        if fd is not None:
+            return fd
+        waiting = self.try_acquire(self.wait_paths)
+        if waiting is None:
+            raise Overloaded()
+        try:
+            deadline = time.monotonic() + timeout
+            delay = 0.001
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Overloaded()
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, 0.05)
+                fd = self.try_acquire(self.run_paths)
+                if fd is not None:
+                    return fd
+        finally:
+            unlock(waiting)
+
+
+class TokenBuckets:
+    """
+    Token buckets in a sqlite file shared by the workers, each take is one
+    short write transaction
+    """
+    def __init__(self, path, rate, burst):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self.local = threading.local()
+        self.takes = 0
+
+    def connection(self):
+        # one connection per thread and process, the workers are forked
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=1, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # the buckets don't need to survive a crash of the host
+            connection.execute("PRAGMA synchronous=OFF")
+            connection.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def take(self, key):
+        """
+        Takes a token from the bucket of key, returns 0 or the seconds to wait
+        for the next token when the bucket is empty
+        """
+        connection = self.connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens = self.burst
+            if row is not None:
+                tokens = min(self.burst, row[0] + (now - row[1]) * self.rate)
+            wait = 0
+            if tokens < 1:
+                wait = (1 - tokens) / self.rate
+            else:
+                connection.execute(
+                    "INSERT INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+                    (key, tokens - 1, now)
+                )
+            self.takes += 1
+            if self.takes % 1000 == 0:
+                # the buckets that have filled up again are the same as no bucket
+                connection.execute("DELETE FROM buckets WHERE updated_at < ?", (now - self.burst / self.rate,))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return wait
+
+
+def parse_keys(value):
+    # "key1,key2" -> {"key1", "key2"}
+    return frozenset(key.strip() for key in (value or "").split(",") if key.strip() != "")
+
+
+def client_key(api_keys):
+    # only trusted values, a client can't get a new bucket by sending a new
+    # key, and the sqlite file can't grow with made-up keys
+    api_key = request.headers.get("X-API-Key")
+    if api_key and api_key in api_keys:
+        return "key:" + api_key
+    identity = jwt_identity()
+    if identity is not None:
+        return "user:" + str(identity)
+    return "ip:" + str(request.remote_addr)
+
+
+def shared_directory(app):
+    # the directory of the files shared by the workers of the host
+    directory = app.config.get("ADMISSION_DIR") or os.path.join(tempfile.gettempdir(), "starwars-api-admission")
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def rejected(message, status_code, retry_after):
+    response, status = APIException(message, status_code=status_code).to_response()
+    response.status_code = status
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+class Admission:
+    def __init__(self):
+        self.slots = {}
+        self.buckets = None
+        self.api_keys = frozenset()
+
+    def init_app(self, app):
+        default = app.config.get("CONCURRENCY_LIMIT", 0)
+        limits = parse_limits(app.config.get("CONCURRENCY_LIMITS"))
+        rate = app.config.get("RATE_LIMIT_PER_SECOND", 0)
+        if default == 0 and len(limits) == 0 and rate == 0:
+            return
+        directory = shared_directory(app)
+        self.directory = directory
+        self.default = default
+        self.limits = limits
+        if rate > 0:
+            burst = app.config.get("RATE_LIMIT_BURST") or max(1, math.ceil(rate))
+            self.buckets = TokenBuckets(os.path.join(directory, "buckets.db"), rate, burst)
+            self.api_keys = parse_keys(app.config.get("API_KEYS"))
+        app.before_request(self.before_request)
+        app.teardown_request(self.teardown_request)
+
+    def endpoint_slots(self, endpoint):
+        if endpoint not in self.slots:
+            limit = self.limits.get(endpoint, self.default)
+            slots = None
+            if limit > 0:
+                slots = Slots(self.directory, endpoint, limit, current_app.config.get("ADMISSION_QUEUE_SIZE", 16))
+            self.slots[endpoint] = slots
+        return self.slots[endpoint]
+
+    def before_request(self):
+        endpoint = request.endpoint
+        if endpoint is None or endpoint in EXEMPT_ENDPOINTS:
+            return None
+        if self.buckets is not None:
+            wait = self.buckets.take(client_key(self.api_keys))
+            if wait > 0:
+                return rejected("Too many requests, slow down", 429, wait)
+        slots = self.endpoint_slots(endpoint)
+        if slots is not None:
+            timeout = current_app.config.get("ADMISSION_TIMEOUT_MS", 1000) / 1000
+            try:
+                # kept in the environ rather than g, the sub-requests of
+                # /batch share g and end before the batch does
+                request.environ["admission.slot"] = slots.acquire(timeout)
+            except Overloaded:
+                return rejected("The server is overloaded, try again later", 503, timeout)
+        return None
+
+    def teardown_request(self, error=None):
+        fd = request.environ.pop("admission.slot", None)
+        if fd is not None:
+            unlock(fd)
+
+
+admission = Admission()
@@ -0,0 +1,242 @@
+"""
+ASGI entry point, an alternative to wsgi.py:
+
+    $ pipenv install uvicorn aiosqlite   # or asyncpg / aiomysql
+    $ pipenv run uvicorn asgi:application --app-dir src --workers 4
+
+The read routes of people, planets, vehicles and users are served with an async
+SQLAlchemy engine, so a worker keeps many requests in flight while it waits for
+the database. They reuse the resource queries, request parsing and
+serialization of the Flask routes and give the same responses. Every other
+request (writes, exports, search, admin...) is passed to the Flask app in a
+thread.
+"""
+import asyncio
+import io
+import sys
+from flask import g, request
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from werkzeug.test import run_wsgi_app
+from utils import APIException
+from main import create_app
+import includes
+import queries
+import routing
+import versions
+
+# async driver of each database
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+}
+
+
+def async_url(url):
+    """
+    DB_CONNECTION_STRING with the async driver of its database, set
+    ASYNC_DB_CONNECTION_STRING to choose another one
+    """
+    scheme, separator, rest = url.partition("://")
+    dialect = scheme.split("+")[0]
+    if dialect not in ASYNC_DRIVERS:
+        raise ValueError("No async driver for " + scheme + ", set ASYNC_DB_CONNECTION_STRING")
+    return ASYNC_DRIVERS[dialect] + separator + rest
+
+
+app = create_app()
+url = app.config.get("ASYNC_DB_CONNECTION_STRING") or async_url(app.config["SQLALCHEMY_DATABASE_URI"])
+engine = create_async_engine(url, **app.config["SQLALCHEMY_ENGINE_OPTIONS"])
+# the reads follow the same routing as the Flask session
+replica_engine = None
+if app.config.get("DB_REPLICA_CONNECTION_STRING"):
+    replica_engine = create_async_engine(async_url(app.config["DB_REPLICA_CONNECTION_STRING"]), **app.config["SQLALCHEMY_ENGINE_OPTIONS"])
+Session = async_sessionmaker(expire_on_commit=False)
+
+
+async def serialize_users(session, items, fields):
+    # queries.serialize_users on the sync session of the async one
+    return await session.run_sync(lambda sync_session: queries.serialize_users(items, fields, sync_session))
+
+
+async def collection(session, resource, key, msg):
+    fields = queries.requested_fields(resource)
+    ids = queries.requested_ids()
+    if ids is not None:
+        result = await session.execute(resource.many_statement(ids, fields, queries.requested_filters(resource)))
+        items, limit, position = resource.in_order(result.scalars().all(), ids), None, None
+    else:
+        limit, position, filters, sort = queries.page_arguments(resource)
+        result = await session.execute(resource.page_statement(limit, position, fields, filters, sort))
+        items, position = resource.page_result(result.scalars().all(), limit, sort)
+    if resource.model is queries.users.model:
+        items = await serialize_users(session, items, fields)
+    else:
+        items = queries.serialize_items(items, fields)
+    return {"msg": msg, key: items, "next": queries.next_page_url(limit, position)}
+
+
+async def detail(session, resource, key, msg, id):
+    fields = queries.requested_fields(resource)
+    result = await session.execute(resource.get_statement(id, fields))
+    item = resource.found(result.scalars().first())
+    if resource.model is queries.users.model:
+        return {key: (await serialize_users(session, [item], fields))[0]}
+    return {"msg": msg, key: item.serialize(fields)}
+
+
+def wsgi_environ(scope, body):
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    server = scope.get("server") or ("localhost", 80)
+    environ["SERVER_NAME"] = server[0]
+    environ["SERVER_PORT"] = str(server[1])
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        if name in environ:
+            value = environ[name] + "," + value
+        environ[name] = value
+    # the body has already been read whole, chunked requests included
+    environ["CONTENT_LENGTH"] = str(len(body))
+    return environ
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+def encode_headers(headers):
+    return [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+
+
+async def respond():
+    """
+    The response of an async read route with the same conditional request
+    handling as versions.conditional
+    """
+    resource, key, msg = queries.read_route(request.endpoint)
+    # the detail routes take the id
+    view = detail if "id" in request.view_args else collection
+    bind = engine
+    if replica_engine is not None and routing.reads_from_replica():
+        bind = replica_engine
+    async with Session(bind=bind) as session:
+        names = versions.resource_tables(resource.table, includes.tables)
+        table_versions = versions.versions_from_rows(await session.execute(versions.versions_statement(names)))
+        g.table_versions = table_versions
+        etag, last_modified = versions.validators(names, table_versions)
+        if versions.is_not_modified(etag, last_modified):
+            response = app.make_response(("", 304))
+        else:
+            response = app.json.response(await view(session, resource, key, msg, **request.view_args))
+    return versions.set_validators(response, etag, last_modified)
+
+
+async def serve_read(environ, send):
+    """
+    Answers an async read route, returns False when the request is for
+    another route
+    """
+    with app.request_context(environ):
+        # the includes load their relationships with the Flask session
+        if request.method != "GET" or request.endpoint not in queries.READ_ROUTES or "include" in request.args:
+            return False
+        # before_request hooks such as the metrics and the admission control,
+        # in a thread as waiting for a slot blocks
+        response = await asyncio.to_thread(app.preprocess_request)
+        if response is not None:
+            response = app.make_response(response)
+        else:
+            try:
+                response = await respond()
+            except APIException as error:
+                response, status = error.to_response()
+                response.status_code = status
+        # after_request hooks such as CORS, the metrics and the compression
+        response = app.process_response(response)
+        await send({
+            "type": "http.response.start",
+            "status": response.status_code,
+            "headers": encode_headers(response.headers.to_wsgi_list()),
+        })
+        await send({"type": "http.response.body", "body": response.get_data()})
+    return True
+
+
+async def serve_flask(environ, send):
+    # the Flask app runs and is iterated in one thread, the chunks of streamed
+    # responses are handed over through a small queue
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=8)
+
+    def put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def run():
+        try:
+            app_iter, status, headers = run_wsgi_app(app, environ)
+            put((int(status.split(" ", 1)[0]), headers.to_wsgi_list()))
+            try:
+                for chunk in app_iter:
+                    put(chunk)
+            finally:
+                if hasattr(app_iter, "close"):
+                    app_iter.close()
+        finally:
+            put(None)
+
+    task = loop.run_in_executor(None, run)
+    start = await queue.get()
+    if start is not None:
+        status, headers = start
+        await send({"type": "http.response.start", "status": status, "headers": encode_headers(headers)})
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    await task
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await engine.dispose()
+                if replica_engine is not None:
+                    await replica_engine.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+    environ = wsgi_environ(scope, await read_body(receive))
+    if not await serve_read(environ, send):
+        await serve_flask(environ, send)
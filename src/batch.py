@@ -0,0 +1,121 @@
+"""
+POST /batch runs several GET requests of the API in one round trip and one
+database session. The detail requests of people, planets and vehicles that
+share a table (and a query string) are answered together: the entity cache is
+read first and the missing rows are loaded with one IN query per table.
+"""
+from urllib.parse import parse_qs
+from flask import current_app, request
+from werkzeug.exceptions import HTTPException
+from utils import APIException
+from cache import entity_cache
+import queries
+import versions
+
+# detail endpoint -> resource query, key and msg of the response
+DETAILS = {detail: queries.READ_ROUTES[detail] for collection, detail in queries.CATALOG_ENDPOINTS.values()}
+
+
+def requested_paths():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("requests"), list):
+        raise APIException("The body must be {\"requests\": [\"/people/1\", ...]}", status_code=400)
+    paths = body["requests"]
+    max_size = current_app.config["BATCH_MAX_REQUESTS"]
+    if len(paths) > max_size:
+        raise APIException("At most " + str(max_size) + " requests can be batched", status_code=400)
+    for path in paths:
+        if not isinstance(path, str) or not path.startswith("/"):
+            raise APIException("Each request must be a path like /people/1", status_code=400)
+    return paths
+
+
+# the headers of the batch passed on to its sub-requests: the cookies keep
+# the reads of a client that has just written on the primary
+FORWARDED_HEADERS = ("Authorization", "Cookie")
+
+
+def sub_request(path):
+    headers = [(name, request.headers[name]) for name in FORWARDED_HEADERS if name in request.headers]
+    return current_app.test_request_context(path, method="GET", headers=headers)
+
+
+def dispatch(path):
+    # the sub-request runs the route itself, inside the app context (and so
+    # the database session) of the batch
+    # /batch itself only accepts POST, so it answers 405 inside a batch
+    with sub_request(path):
+        try:
+            response = current_app.make_response(current_app.dispatch_request())
+        except APIException as error:
+            response = current_app.make_response(error.to_response())
+        except HTTPException as error:
+            return error.code, {"message": error.description}
+        # the body is spliced into the JSON of the batch as it is, the
+        # sitemap, /metrics and the streamed exports can't be
+        if response.mimetype != current_app.json.mimetype or response.is_streamed:
+            response.close()
+            return 400, {"message": "Only JSON routes can be batched"}
+        return response.status_code, response.get_data()
+
+
+def coalesced(endpoint, query_string, group):
+    """
+    Answers the detail requests of one table, group is a list of (position,
+    path, id), returns {position: (status, body)}
+    """
+    resource, key, msg = DETAILS[endpoint]
+    ids = list(dict.fromkeys(id for position, path, id in group))
+    with sub_request(group[0][1]):
+        try:
+            fields = queries.requested_fields(resource)
+        except APIException as error:
+            return {position: (error.status_code, error.to_dict()) for position, path, id in group}
+        if fields is None:
+            def load_many(missing):
+                return {item.id: item.serialize() for item in resource.many(missing)}
+            found = entity_cache.get_many(resource.table, ids, load_many, versions.cache_version(resource.table))
+        else:
+            found = {item.id: item.serialize(fields) for item in resource.many(ids, fields)}
+    results = {}
+    for position, path, id in group:
+        if id in found:
+            results[position] = (200, {"msg": msg, key: found[id]})
+        else:
+            results[position] = (404, {"message": "No " + resource.name + " was found"})
+    return results
+
+
+def run():
+    paths = requested_paths()
+    adapter = current_app.url_map.bind("")
+    groups = {}
+    others = []
+    for position, path in enumerate(paths):
+        route, _, query_string = path.partition("?")
+        try:
+            endpoint, view_args = adapter.match(route, method="GET")
+        except HTTPException:
+            endpoint, view_args = None, {}
+        # the rows with ?include= aren't cached, they go through the route
+        if endpoint in DETAILS and "include" not in parse_qs(query_string):
+            groups.setdefault((endpoint, query_string), []).append((position, path, view_args["id"]))
+        else:
+            others.append((position, path))
+
+    results = {}
+    for (endpoint, query_string), group in groups.items():
+        results.update(coalesced(endpoint, query_string, group))
+    for position, path in others:
+        results[position] = dispatch(path)
+
+    # the bodies of the sub-requests are already encoded, they are inserted
+    # as they are instead of being decoded and encoded again
+    dumps_bytes = current_app.json.dumps_bytes
+    parts = []
+    for position, path in enumerate(paths):
+        status, body = results[position]
+        if not isinstance(body, bytes):
+            body = dumps_bytes(body)
+        parts.append(b'{"body":' + body.strip() + b',"path":' + dumps_bytes(path) + b',"status":' + str(status).encode("ascii") + b"}")
+    return current_app.response_class(b'{"responses":[' + b",".join(parts) + b"]}\n", mimetype=current_app.json.mimetype)
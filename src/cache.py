@@ -0,0 +1,203 @@
+"""
+Read-through cache for serialized entities (people, planets and vehicles).
+Every entry is checked against the current table versions when it is read, so
+a change committed by any process, including the admin and `flask ingest`,
+is seen by every worker on its next read.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from utils import listen_once
+from models import db, Person, Planet, Vehicle
+
+
+class MemoryBackend:
+    """
+    In-process LRU cache with a maximum number of entries and a time to live,
+    each gunicorn worker has its own copy
+    """
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self, prefix=""):
+        with self.lock:
+            for key in [k for k in self.entries if k.startswith(prefix)]:
+                del self.entries[key]
+
+
+class RedisBackend:
+    """
+    Out-of-process cache shared by all the workers of the host, the size bound
+    is redis' own maxmemory setting (use maxmemory-policy allkeys-lru)
+    """
+    def __init__(self, url, ttl=300, namespace="starwars:"):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.namespace = namespace
+
+    def get(self, key):
+        value = self.client.get(self.namespace + key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set(self, key, value):
+        self.client.setex(self.namespace + key, self.ttl, json.dumps(value))
+
+    def delete(self, key):
+        self.client.delete(self.namespace + key)
+
+    def clear(self, prefix=""):
+        keys = list(self.client.scan_iter(match=self.namespace + prefix + "*"))
+        if len(keys) > 0:
+            self.client.delete(*keys)
+
+
+class EntityCache:
+    """
+    The entries are stored with the versions of the tables they were
+    serialized from (see versions.cache_version) and only returned to a reader
+    that sees the same versions. A write made by another worker or process
+    bumps the versions in the database, so it can't leave an old row behind
+    in this worker's cache, and an old row cached between the flush and the
+    commit of a write is never read with the versions of that write.
+    """
+    def __init__(self):
+        self.backend = None
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        backend = app.config.get("CACHE_BACKEND", "memory")
+        ttl = app.config.get("CACHE_TTL", 300)
+        if backend == "memory":
+            self.backend = MemoryBackend(app.config.get("CACHE_MAX_SIZE", 10000), ttl)
+        elif backend == "redis":
+            self.backend = RedisBackend(app.config["CACHE_REDIS_URL"], ttl)
+        elif backend != "none":
+            raise ValueError("Unknown CACHE_BACKEND " + backend)
+        listen_once(db.session, "after_flush", self.after_flush)
+        listen_once(db.session, "after_commit", self.after_commit)
+        listen_once(db.session, "after_rollback", self.after_rollback)
+
+    def lookup(self, key, version):
+        # the entry of key, None when it was stored with other versions
+        entry = self.backend.get(key)
+        # the redis backend returns the version tuple as a list
+        if entry is None or list(entry[0]) != list(version):
+            return None, entry
+        return entry[1], entry
+
+    def store(self, key, version, value, entry):
+        # a reader that lags behind, like one on the replica, doesn't replace
+        # the entry of a newer version
+        if entry is not None and all(a >= b for a, b in zip(entry[0], version)):
+            return
+        self.backend.set(key, (version, value))
+
+    def get(self, table, id, load, version):
+        """
+        Returns the cached value of table/id for version, or calls load() and
+        caches the result
+        """
+        if self.backend is None:
+            return load()
+        key = table + ":" + str(id)
+        value, entry = self.lookup(key, version)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = load()
+        self.store(key, version, value, entry)
+        return value
+
+    def get_many(self, table, ids, load_many, version):
+        """
+        Returns {id: value} for the ids found, the ids that are not cached are
+        loaded together with load_many(ids), which returns {id: value}
+        """
+        if self.backend is None:
+            return load_many(ids)
+        values = {}
+        entries = {}
+        for id in ids:
+            value, entries[id] = self.lookup(table + ":" + str(id), version)
+            if value is not None:
+                values[id] = value
+        self.hits += len(values)
+        missing = [id for id in ids if id not in values]
+        if len(missing) > 0:
+            self.misses += len(missing)
+            for id, value in load_many(missing).items():
+                self.store(table + ":" + str(id), version, value, entries[id])
+                values[id] = value
+        return values
+
+    def invalidate(self, table, id):
+        if self.backend is not None:
+            self.backend.delete(table + ":" + str(id))
+
+    def invalidate_table(self, table):
+        if self.backend is not None:
+            self.backend.clear(table + ":")
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def after_flush(self, session, flush_context):
+        # the versions already keep the entries of the written rows from being
+        # read, dropping them frees the memory. They are dropped again after
+        # the commit, a read in between may have cached them again
+        written = session.info.setdefault("cache_written", set())
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(obj, (Person, Planet, Vehicle)) and obj.id is not None:
+                written.add((obj.__tablename__, obj.id))
+                # people embed the name of their homeworld
+                if isinstance(obj, Planet):
+                    written.add(("people", None))
+        self.drop(written)
+
+    def after_commit(self, session):
+        self.drop(session.info.pop("cache_written", ()))
+
+    def after_rollback(self, session):
+        session.info.pop("cache_written", None)
+
+    def drop(self, written):
+        for table, id in written:
+            if id is None:
+                self.invalidate_table(table)
+            else:
+                self.invalidate(table, id)
+
+
+entity_cache = EntityCache()
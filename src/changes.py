@@ -0,0 +1,139 @@
+"""
+Change feed for delta sync: every create, update and delete of people, planets
+and vehicles is appended to the change_log table in the transaction that makes
+it, from the session events (so the admin's edits are logged too) and from
+`flask ingest`. GET /changes?since=<seq> returns the changes after seq with
+the current version of each row, a client that keeps the last seq it has seen
+only downloads what changed since.
+
+The writers take the lock of the "change_log" row of table_versions before
+appending, so the seqs are committed in order and a client never skips a
+change that commits after it has read a higher seq. They take it after the
+rows of the tables they write, never before, so two writers can't deadlock.
+"""
+from sqlalchemy import inspect
+from flask import request, url_for
+from utils import APIException, listen_once
+from models import db, Change, Person, Planet, Vehicle
+import queries
+import versions
+
+# logged table -> resource query
+RESOURCES = {
+    "people": queries.people,
+    "planets": queries.planets,
+    "vehicles": queries.vehicles,
+}
+
+
+def record(connection, changes):
+    """
+    Appends changes, a list of (table, id, op), to the log
+    """
+    versions.bump(connection, {"change_log"})
+    now = versions.utcnow()
+    connection.execute(Change.__table__.insert(), [
+        {"table_name": table, "row_id": id, "op": op, "changed_at": now} for table, id, op in changes
+    ])
+
+
+def record_select(connection, table, ids, op):
+    """
+    Appends a change for every id of the select ids, in the database
+    """
+    versions.bump(connection, {"change_log"})
+    ids = ids.subquery()
+    columns = Change.__table__.c
+    connection.execute(Change.__table__.insert().from_select(
+        [columns.table_name, columns.row_id, columns.op, columns.changed_at],
+        db.select(db.literal(table), ids.c[0], db.literal(op), db.literal(versions.utcnow()))
+    ))
+
+
+def after_flush(session, flush_context):
+    changes = []
+    renamed = []
+    for obj in session.new:
+        if isinstance(obj, (Person, Planet, Vehicle)):
+            changes.append((obj.__tablename__, obj.id, "create"))
+    for obj in session.dirty:
+        # changes to a collection, like the characters of a planet, are logged
+        # on the rows whose foreign key changes
+        if isinstance(obj, (Person, Planet, Vehicle)) and session.is_modified(obj, include_collections=False):
+            changes.append((obj.__tablename__, obj.id, "update"))
+            if isinstance(obj, Planet) and inspect(obj).attrs.name.history.has_changes():
+                renamed.append(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, (Person, Planet, Vehicle)):
+            changes.append((obj.__tablename__, obj.id, "delete"))
+
+    connection = session.connection()
+    if len(changes) > 0:
+        record(connection, changes)
+    # people embed the name of their homeworld
+    if len(renamed) > 0:
+        record_select(connection, "people", db.select(Person.id).where(Person.homeworld_id.in_(renamed)), "update")
+
+
+def init_app(app):
+    listen_once(db.session, "after_flush", after_flush)
+
+
+def last_seq():
+    return db.session.execute(db.select(db.func.max(Change.seq))).scalar() or 0
+
+
+def current_rows(changes):
+    """
+    {(table, id): serialized row} of the rows that still exist, with one query
+    per table. The entity cache is not used, the feed must not return an
+    older row than the change it comes with
+    """
+    ids = {}
+    for change in changes:
+        if change.op != "delete":
+            ids.setdefault(change.table_name, []).append(change.row_id)
+    rows = {}
+    for table, table_ids in ids.items():
+        for item in RESOURCES[table].many(list(dict.fromkeys(table_ids))):
+            rows[(table, item.id)] = item.serialize()
+    return rows
+
+
+def serialize_change(change, rows):
+    return {
+        "seq": change.seq,
+        "table": change.table_name,
+        "id": change.row_id,
+        "op": change.op,
+        "changed_at": change.changed_at.isoformat() + "Z",
+        # the current version of the row, None once it has been deleted
+        "data": rows.get((change.table_name, change.row_id)),
+    }
+
+
+def changes_since():
+    """
+    Returns the page of changes asked for by ?since=&limit=, the last seq to
+    send as ?since= next time and the url of the next page. Without ?since=
+    there are no changes, only the current last seq
+    """
+    since = request.args.get("since")
+    if since is None:
+        return [], last_seq(), None
+    try:
+        since = int(since)
+    except ValueError:
+        raise APIException("since must be a number", status_code=400)
+    limit = queries.page_limit(100)
+    changes = db.session.execute(
+        db.select(Change).where(Change.seq > since).order_by(Change.seq).limit(limit + 1)
+    ).scalars().all()
+    next_url = None
+    if len(changes) > limit:
+        changes = changes[:limit]
+        next_url = url_for("get_changes", since=changes[-1].seq, limit=limit)
+    if len(changes) > 0:
+        since = changes[-1].seq
+    rows = current_rows(changes)
+    return [serialize_change(change, rows) for change in changes], since, next_url
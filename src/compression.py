@@ -0,0 +1,93 @@
+"""
+gzip and brotli compression of the JSON responses, negotiated with the
+Accept-Encoding header. Bodies smaller than COMPRESS_MIN_SIZE are sent as they
+are, brotli needs `pipenv install brotli` and is preferred when the client
+accepts both.
+
+The compressed bodies of the routes that have an ETag (see versions.py) are
+kept in an LRU keyed by ETag and encoding, so a collection is compressed once
+per version instead of once per request. The ETag of a JSON response, 304s
+included, is made weak when the client accepts an encoding: the bytes differ
+from the uncompressed ones but it still matches If-None-Match.
+"""
+import gzip
+from flask import current_app, request
+from cache import MemoryBackend
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class Compressor:
+    def __init__(self):
+        self.cache = None
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        """
+        Must be called after metrics.init_app so the response size recorded
+        is the compressed one
+        """
+        self.cache = MemoryBackend(app.config["COMPRESS_CACHE_SIZE"], app.config["CACHE_TTL"])
+        app.after_request(self.after_request)
+
+    def encoding(self):
+        # the accepted encoding with the highest quality, brotli on ties
+        encodings = request.accept_encodings
+        best = None
+        for name in ("br", "gzip"):
+            if name == "br" and brotli is None:
+                continue
+            if encodings[name] > 0 and (best is None or encodings[name] > encodings[best]):
+                best = name
+        return best
+
+    def compress(self, data, encoding):
+        config = current_app.config
+        if encoding == "br":
+            return brotli.compress(data, quality=config["COMPRESS_BROTLI_QUALITY"])
+        # mtime=0 gives the same bytes for the same body
+        return gzip.compress(data, compresslevel=config["COMPRESS_GZIP_LEVEL"], mtime=0)
+
+    def after_request(self, response):
+        if response.mimetype != current_app.json.mimetype and response.status_code != 304:
+            return response
+        response.vary.add("Accept-Encoding")
+        if response.status_code not in (200, 304) or response.is_streamed or "Content-Encoding" in response.headers:
+            return response
+        encoding = self.encoding()
+        if encoding is None:
+            return response
+        # weak whenever the client accepts an encoding, the body of a 304 is
+        # not there to tell if the 200 would have been compressed
+        etag, weak = response.get_etag()
+        if etag is not None:
+            response.set_etag(etag, weak=True)
+        if response.status_code == 304:
+            return response
+        data = response.get_data()
+        if len(data) < current_app.config["COMPRESS_MIN_SIZE"]:
+            return response
+
+        key = None
+        if etag is not None and not weak:
+            key = etag + ":" + encoding
+        body = self.cache.get(key) if key is not None else None
+        if body is None:
+            self.misses += 1
+            body = self.compress(data, encoding)
+            if key is not None:
+                self.cache.set(key, body)
+        else:
+            self.hits += 1
+
+        response.direct_passthrough = False
+        response.set_data(body)
+        response.headers["Content-Encoding"] = encoding
+        return response
+
+
+compressor = Compressor()
@@ -0,0 +1,76 @@
+"""
+JSON encoder backends: JSON_BACKEND picks the encoder used by jsonify, the error
+handler, the exports and the snapshot. "orjson" needs `pipenv install orjson`,
+"auto" uses it when it is installed and falls back to the standard library.
+Both backends accept model rows directly and serialize them with their
+serialize() method, so routes don't need to build intermediate lists.
+"""
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class StdlibJSONProvider(DefaultJSONProvider):
+    # raw UTF-8 like orjson, instead of \u escapes
+    ensure_ascii = False
+
+    @staticmethod
+    def default(o):
+        if hasattr(o, "serialize"):
+            return o.serialize()
+        return DefaultJSONProvider.default(o)
+
+    def dumps_bytes(self, obj, **kwargs):
+        kwargs.setdefault("separators", (",", ":"))
+        return self.dumps(obj, **kwargs).encode("utf-8")
+
+
+class OrjsonJSONProvider(DefaultJSONProvider):
+    def options(self, indent=False):
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    @staticmethod
+    def default(o):
+        if hasattr(o, "serialize"):
+            return o.serialize()
+        return DefaultJSONProvider.default(o)
+
+    def dumps_bytes(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.options())
+
+    def dumps(self, obj, **kwargs):
+        return self.dumps_bytes(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = self.compact is False or (self.compact is None and self._app.debug)
+        body = orjson.dumps(obj, default=self.default, option=self.options(indent))
+        return self._app.response_class(body + b"\n", mimetype=self.mimetype)
+
+
+BACKENDS = {
+    "stdlib": StdlibJSONProvider,
+    "orjson": OrjsonJSONProvider,
+}
+
+
+def init_app(app):
+    backend = app.config.get("JSON_BACKEND", "auto")
+    if backend == "auto":
+        backend = "orjson" if orjson is not None else "stdlib"
+    if backend not in BACKENDS:
+        raise ValueError("Unknown JSON_BACKEND " + backend)
+    if backend == "orjson" and orjson is None:
+        raise ValueError("JSON_BACKEND is orjson but orjson is not installed")
+    app.json = BACKENDS[backend](app)
@@ -0,0 +1,321 @@
+"""
+Favorites: the favorite_count of people, planets and vehicles is kept up to date
+from the changes to the users' favorites, so "most favorited" lists are read
+from an index on the counter instead of counting the junction tables.
+
+The favorites of the logged in users (/me/favorites) are read from an
+in-memory index of (type, id) pairs per user, checked against a generation of
+each user shared by the workers of the host, so their writes are seen without
+asking the database.
+"""
+import os
+import sqlite3
+import threading
+from sqlalchemy import inspect
+from utils import APIException, listen_once
+from cache import MemoryBackend
+from admission import shared_directory
+from models import db, User, Person, Planet, Vehicle, favorite_people, favorite_planets, favorite_vehicles
+import versions
+
+# user relationship -> favorited model
+RELATIONSHIPS = {
+    "people": Person,
+    "planets": Planet,
+    "vehicles": Vehicle,
+}
+
+# favorite type -> (model, junction table, junction column)
+TYPES = {
+    "person": (Person, favorite_people, favorite_people.c.person_id),
+    "planet": (Planet, favorite_planets, favorite_planets.c.planet_id),
+    "vehicle": (Vehicle, favorite_vehicles, favorite_vehicles.c.vehicle_id),
+}
+
+
+class FileGenerations:
+    """
+    The generation of each user in a sqlite file shared by the workers of the
+    host, a read is one lookup in the file without a transaction
+    """
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def connection(self):
+        # one connection per thread and process, the workers are forked
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=1, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS generations (username TEXT PRIMARY KEY, generation INTEGER NOT NULL)")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def get(self, username):
+        row = self.connection().execute("SELECT generation FROM generations WHERE username = ?", (username,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def bump(self, usernames):
+        # the rows are never deleted, a user going back to generation 0 would
+        # match the entries loaded before their first write
+        self.connection().executemany(
+            "INSERT INTO generations (username, generation) VALUES (?, 1) "
+            "ON CONFLICT (username) DO UPDATE SET generation = generation + 1",
+            [(username,) for username in usernames]
+        )
+
+
+class RedisGenerations:
+    """
+    The generation of each user in redis, shared by the workers of every host
+    """
+    def __init__(self, url, namespace="starwars:favorites:"):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.namespace = namespace
+
+    def get(self, username):
+        return int(self.client.get(self.namespace + username) or 0)
+
+    def bump(self, usernames):
+        pipeline = self.client.pipeline()
+        for username in usernames:
+            pipeline.incr(self.namespace + username)
+        pipeline.execute()
+
+
+class FavoritesIndex:
+    """
+    The favorites of each user as a frozenset of (type, id) pairs, keyed by
+    username. The least recently used users are evicted past
+    FAVORITES_INDEX_SIZE or after FAVORITES_INDEX_TTL seconds. Each worker has
+    its own copy, an entry is stored with the generation of its user and
+    loaded again once a write (of any worker) has bumped it. The generations
+    are in redis with CACHE_BACKEND=redis, else in a file of ADMISSION_DIR
+    """
+    def __init__(self):
+        self.backend = None
+        self.generations = None
+
+    def init_app(self, app):
+        self.backend = MemoryBackend(app.config.get("FAVORITES_INDEX_SIZE", 10000), app.config.get("FAVORITES_INDEX_TTL", 60))
+        if app.config.get("CACHE_BACKEND") == "redis":
+            self.generations = RedisGenerations(app.config["CACHE_REDIS_URL"])
+        else:
+            self.generations = FileGenerations(os.path.join(shared_directory(app), "favorites.db"))
+
+    def load(self, username):
+        user_id = user_id_of(username)
+        statement = db.union_all(*[
+            db.select(db.literal(resource_type), column).where(table.c.user_id == user_id)
+            for resource_type, (model, table, column) in TYPES.items()
+        ])
+        return user_id, frozenset(tuple(row) for row in db.session.execute(statement))
+
+    def get(self, username):
+        """
+        Returns (user id, favorites) of username without any query while its
+        entry is up to date, the favorites are loaded with two queries when
+        they are not in the index or another write has bumped the generation
+        """
+        # read before loading, a write committed in between bumps it again
+        generation = self.generations.get(username)
+        entry = self.backend.get(username)
+        if entry is None or entry[0] != generation:
+            entry = (generation,) + self.load(username)
+            self.backend.set(username, entry)
+        return entry[1:]
+
+    def invalidate(self, usernames):
+        if self.backend is None:
+            return
+        for username in usernames:
+            self.backend.delete(username)
+        self.generations.bump(usernames)
+
+
+favorites_index = FavoritesIndex()
+
+
+def before_flush(session, flush_context, instances):
+    # the changes are collected before the flush, while the collections still
+    # hold the favorites of the users being deleted
+    deltas = session.info.setdefault("favorite_deltas", [])
+    usernames = session.info.setdefault("favorite_usernames", set())
+    for user in list(session.new) + list(session.dirty):
+        if not isinstance(user, User):
+            continue
+        state = inspect(user)
+        for relationship in RELATIONSHIPS:
+            history = state.attrs[relationship].history
+            deltas += [(item, 1) for item in history.added]
+            deltas += [(item, -1) for item in history.deleted]
+        usernames.add(user.username)
+        usernames.update(state.attrs.username.history.deleted)
+    for user in session.deleted:
+        if isinstance(user, User):
+            for relationship in RELATIONSHIPS:
+                deltas += [(item, -1) for item in getattr(user, relationship)]
+            usernames.add(user.username)
+
+
+def after_flush(session, flush_context):
+    # applied with plain UPDATEs, the rows are not marked as changed so the
+    # caches and versions of the catalog stay valid
+    deltas = session.info.pop("favorite_deltas", [])
+    totals = {}
+    for item, delta in deltas:
+        key = (type(item), item.id)
+        totals[key] = totals.get(key, 0) + delta
+    updates = {}
+    for (model, id), delta in totals.items():
+        if delta != 0:
+            updates.setdefault((model, delta), []).append(id)
+    connection = session.connection()
+    for (model, delta), ids in updates.items():
+        table = model.__table__
+        connection.execute(
+            table.update()
+            .where(table.c.id.in_(ids))
+            .values(favorite_count=table.c.favorite_count + delta)
+        )
+
+
+def after_commit(session):
+    # dropped once committed, a read in between would put the old favorites back
+    usernames = session.info.pop("favorite_usernames", ())
+    if len(usernames) > 0:
+        favorites_index.invalidate(usernames)
+
+
+def after_rollback(session):
+    session.info.pop("favorite_deltas", None)
+    session.info.pop("favorite_usernames", None)
+
+
+def init_app(app):
+    favorites_index.init_app(app)
+    listen_once(db.session, "before_flush", before_flush)
+    listen_once(db.session, "after_flush", after_flush)
+    listen_once(db.session, "after_commit", after_commit)
+    listen_once(db.session, "after_rollback", after_rollback)
+
+
+def popular(resource, limit, fields=None):
+    """
+    The limit most favorited rows of the resource, read backwards from the
+    (favorite_count, id) index so it only touches limit rows
+    """
+    model = resource.model
+    return (
+        resource.query(fields, [model.favorite_count])
+        .order_by(model.favorite_count.desc(), model.id.desc())
+        .limit(limit)
+        .all()
+    )
+
+
+def serialize_ids(favorites):
+    # {"people": [...], "planets": [...], "vehicles": [...]} of the index pairs
+    result = {}
+    for relationship, resource_type in zip(RELATIONSHIPS, TYPES):
+        result[relationship] = sorted(id for t, id in favorites if t == resource_type)
+    return result
+
+
+def favorite_type(resource_type):
+    if resource_type not in TYPES:
+        raise APIException("type must be one of " + ", ".join(TYPES), status_code=400)
+    return resource_type
+
+
+def serialize_popular(items, fields=None):
+    result = []
+    for item in items:
+        serialized = item.serialize(fields=fields)
+        serialized["favorite_count"] = item.favorite_count
+        result.append(serialized)
+    return result
+
+
+def user_id_of(username):
+    user_id = db.session.execute(db.select(User.id).where(User.username == username)).scalar()
+    if user_id is None:
+        raise APIException("No user was found", status_code=404)
+    return user_id
+
+
+def apply_operations(user_id, operations):
+    """
+    Adds and removes many favorites of a user in one transaction:
+    operations is a list of {"op": "add" | "remove", "type": ..., "id": ...}.
+    Adding an existing favorite or removing a missing one does nothing, when
+    the same favorite appears several times the last operation wins. The ids
+    are validated with one query per type before anything is written.
+    """
+    if not isinstance(operations, list):
+        raise APIException("operations must be a list", status_code=400)
+    final = {}
+    for operation in operations:
+        if not isinstance(operation, dict):
+            raise APIException("Each operation must be an object", status_code=400)
+        op = operation.get("op", "add")
+        resource_type = operation.get("type")
+        resource_id = operation.get("id")
+        if op not in ("add", "remove"):
+            raise APIException("op must be 'add' or 'remove'", status_code=400)
+        if resource_type not in TYPES:
+            raise APIException("type must be one of " + ", ".join(TYPES), status_code=400)
+        try:
+            resource_id = int(resource_id)
+        except (TypeError, ValueError):
+            raise APIException("id must be a number", status_code=400)
+        final[(resource_type, resource_id)] = op
+
+    # the lock on the user's row orders the concurrent changes to their
+    # favorites, each one sees the favorites the previous one committed
+    username = db.session.execute(
+        db.select(User.username).where(User.id == user_id).with_for_update()
+    ).scalar()
+    if username is None:
+        raise APIException("No user was found", status_code=404)
+    # dropped from the index once committed, see after_commit
+    db.session.info.setdefault("favorite_usernames", set()).add(username)
+
+    connection = db.session.connection()
+    ids_by_type = {}
+    for resource_type, (model, table, column) in TYPES.items():
+        ids = [id for (t, id) in final if t == resource_type]
+        if len(ids) == 0:
+            continue
+        found = set(connection.execute(db.select(model.id).where(model.id.in_(ids))).scalars())
+        missing = [id for id in ids if id not in found]
+        if len(missing) > 0:
+            raise APIException("No " + resource_type + " was found with id " + ", ".join(map(str, missing)), status_code=404)
+        ids_by_type[resource_type] = ids
+
+    for resource_type, ids in ids_by_type.items():
+        model, table, column = TYPES[resource_type]
+        existing = set(connection.execute(
+            db.select(column).where(table.c.user_id == user_id, column.in_(ids))
+        ).scalars())
+        added = [id for id in ids if final[(resource_type, id)] == "add" and id not in existing]
+        removed = [id for id in ids if final[(resource_type, id)] == "remove" and id in existing]
+        # one multi-row INSERT and one DELETE per type, the counts move by
+        # exactly the rows they write
+        if len(added) > 0:
+            connection.execute(table.insert(), [{"user_id": user_id, column.name: id} for id in added])
+        if len(removed) > 0:
+            connection.execute(table.delete().where(table.c.user_id == user_id, column.in_(removed)))
+        for delta, changed in ((1, added), (-1, removed)):
+            if len(changed) > 0:
+                connection.execute(
+                    model.__table__.update()
+                    .where(model.__table__.c.id.in_(changed))
+                    .values(favorite_count=model.__table__.c.favorite_count + delta)
+                )
+
+    versions.bump(connection, {"users"})
+    db.session.commit()
@@ -0,0 +1,176 @@
+"""
+?include= embeds related rows in the responses: the homeworld of people (the
+planet instead of its name), the characters of planets and the favorites of
+users. Nested includes are dotted, /users?include=favorites.homeworld. Each
+level is loaded for all the rows of the response together, with one query per
+relationship, and a row referenced by many others (the homeworld of many
+characters) is serialized only once.
+"""
+from flask import request
+from utils import APIException
+from models import db, User, Person, Planet, Vehicle
+import queries
+
+
+def homeworlds(people):
+    ids = list(dict.fromkeys(person.homeworld_id for person in people if person.homeworld_id is not None))
+    planets = {}
+    if len(ids) > 0:
+        planets = {planet.id: planet for planet in queries.planets.many(ids)}
+    return {person.id: {"homeworld": planets.get(person.homeworld_id)} for person in people}
+
+
+def characters(planets):
+    result = {planet.id: {"characters": []} for planet in planets}
+    statement = queries.people.statement().where(Person.homeworld_id.in_(list(result))).order_by(Person.id)
+    for person in db.session.execute(statement).scalars():
+        result[person.homeworld_id]["characters"].append(person)
+    return result
+
+
+def favorites(users):
+    ids = queries.favorite_ids([user.id for user in users])
+    result = {user.id: {} for user in users}
+    for key, resource in (("people", queries.people), ("planets", queries.planets), ("vehicles", queries.vehicles)):
+        wanted = list(dict.fromkeys(id for user in users for id in ids[user.id][key]))
+        rows = {}
+        if len(wanted) > 0:
+            rows = {row.id: row for row in resource.many(wanted)}
+        for user in users:
+            result[user.id]["favorite_" + key] = [rows[id] for id in ids[user.id][key] if id in rows]
+    return result
+
+
+# model -> include name -> function loading it for a list of rows, keys of
+# the serialized rows it sets and models it embeds. The functions return
+# {row id: {key: row, None or list of rows}}
+RELATIONS = {
+    Person: {"homeworld": (homeworlds, ("homeworld",), (Planet,))},
+    Planet: {"characters": (characters, ("characters",), (Person,))},
+    User: {"favorites": (favorites, ("favorite_people", "favorite_planets", "favorite_vehicles"), (Person, Planet, Vehicle))},
+}
+
+
+def requested(model):
+    """
+    Reads ?include=homeworld,favorites.homeworld into a tree of names like
+    {"homeworld": {}, "favorites": {"homeworld": {}}}, checked against the
+    relationships of model
+    """
+    tree = {}
+    for path in request.args.get("include", "").split(","):
+        path = path.strip()
+        if path == "":
+            continue
+        models = (model,)
+        node = tree
+        for name in path.split("."):
+            relations = [RELATIONS[m][name] for m in models if name in RELATIONS.get(m, {})]
+            if len(relations) == 0:
+                raise APIException("Unknown include " + path, status_code=400)
+            models = tuple(m for relation in relations for m in relation[2])
+            node = node.setdefault(name, {})
+    return tree
+
+
+def tables(model):
+    # the tables read by the includes of the request, they are part of the ETag
+    names = set()
+
+    def walk(models, tree):
+        for name, nested in tree.items():
+            for m in models:
+                if name in RELATIONS.get(m, {}):
+                    targets = RELATIONS[m][name][2]
+                    names.update(target.__tablename__ for target in targets)
+                    walk(targets, nested)
+
+    walk((model,), requested(model))
+    return names
+
+
+def fields_without(model, tree, fields=None):
+    # the fields of model except the ones the includes of tree replace
+    replaced = set()
+    for name in tree:
+        if name in RELATIONS.get(model, {}):
+            replaced.update(RELATIONS[model][name][1])
+    return [name for name in fields or model.serialize_fields if name not in replaced]
+
+
+def identity(row):
+    return (row.__tablename__, row.id)
+
+
+def expand(items, results, tree):
+    """
+    Adds the includes of tree to results, the serialized items, all the items
+    are of the same model
+    """
+    if len(items) == 0:
+        return
+    relations = RELATIONS.get(type(items[0]), {})
+    for name, nested in tree.items():
+        if name not in relations:
+            continue
+        loaded = relations[name][0](items)
+
+        # the related rows of all the items grouped by model, each row once
+        related = {}
+        for values in loaded.values():
+            for value in values.values():
+                for row in value if isinstance(value, list) else [value]:
+                    if row is not None:
+                        related.setdefault(type(row), {})[identity(row)] = row
+        serialized = {}
+        for model, rows in related.items():
+            rows = list(rows.values())
+            fields = fields_without(model, nested)
+            rows_serialized = [row.serialize(fields=fields) for row in rows]
+            expand(rows, rows_serialized, nested)
+            for row, result in zip(rows, rows_serialized):
+                serialized[identity(row)] = result
+
+        for item, result in zip(items, results):
+            for key, value in loaded[item.id].items():
+                if isinstance(value, list):
+                    result[key] = [serialized[identity(row)] for row in value]
+                else:
+                    result[key] = None if value is None else serialized[identity(value)]
+
+
+def loaded_fields(resource, fields=None):
+    """
+    The fields to load for the rows of resource, without the ones the includes
+    replace since they are loaded separately
+    """
+    tree = requested(resource.model)
+    if len(tree) == 0:
+        return fields
+    return fields_without(resource.model, tree, fields)
+
+
+def serialize(resource, items, fields=None, serialize=queries.serialize_items):
+    """
+    The serialized items with the includes of the request, serialize is used
+    when there are none. The items must have been loaded with loaded_fields
+    """
+    tree = requested(resource.model)
+    if len(tree) == 0:
+        return serialize(items, fields)
+    model_fields = fields_without(resource.model, tree, fields)
+    results = [item.serialize(fields=model_fields) for item in items]
+    expand(items, results, tree)
+    return results
+
+
+def get_serialized(resource, id, serialize_items=None):
+    """
+    queries.get_serialized with the includes, those rows aren't cached and
+    neither are the ones of a route with its own serialize_items
+    """
+    if len(requested(resource.model)) == 0 and serialize_items is None:
+        return queries.get_serialized(resource, id)
+    fields = queries.requested_fields(resource)
+    item = resource.get(id, loaded_fields(resource, fields))
+    return serialize(resource, [item], fields, serialize_items or queries.serialize_items)[0]
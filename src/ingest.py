@@ -0,0 +1,286 @@
+"""
+`flask ingest` loads SWAPI-style dumps of people, planets or vehicles:
+
+    $ pipenv run flask ingest planets planets.json
+    $ pipenv run flask ingest people people.ndjson --workers 4 --upsert
+
+The input is read as a stream (NDJSON line by line, JSON arrays with ijson when
+it is installed) and written in chunks: COPY into a temporary table on
+PostgreSQL, multi-row INSERTs (executemany) elsewhere. The homeworld of the
+people is resolved once per chunk. Each chunk is its own transaction, which
+also bumps the table version and logs the chunk's rows to the change feed, so
+the readers see every chunk once it commits and an interrupted load can be
+resumed with --upsert.
+"""
+import csv
+import io
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+import click
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from models import db, Person, Planet, Vehicle, parse_number
+from cache import entity_cache
+import changes
+import versions
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# table -> (model, columns read from the dump)
+RESOURCES = {
+    "people": (Person, ["name", "height", "mass", "hair_color", "skin_color", "eye_color", "birth_year", "gender", "description", "photo_url"]),
+    "planets": (Planet, ["name", "diameter", "rotation_period", "orbital_period", "gravity", "population", "climate", "terrain", "surface_water", "description", "photo_url"]),
+    "vehicles": (Vehicle, ["name", "model", "vehicle_class", "manufacturer", "cost_in_credits", "length", "crew", "passengers", "max_atmosphering_speed", "cargo_capacity", "consumables", "description", "photo_url"]),
+}
+
+URL_ID = re.compile(r"/(\d+)/?$")
+
+
+def read_records(path):
+    """
+    Yields the objects of a dump: NDJSON, a JSON array, or a SWAPI page
+    like {"results": [...]}
+    """
+    with open(path, "rb") as f:
+        if path.endswith((".ndjson", ".jsonl")):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+        start = f.read(1)
+        while start and start.isspace():
+            start = f.read(1)
+        f.seek(0)
+        if ijson is not None:
+            prefix = "item" if start == b"[" else "results.item"
+            yield from ijson.items(f, prefix)
+            return
+        data = json.load(f)
+        if isinstance(data, dict):
+            data = data.get("results", [data])
+        yield from data
+
+
+def url_id(value):
+    # "https://swapi.dev/api/planets/1/" -> 1
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        if value.isdigit():
+            return int(value)
+        match = URL_ID.search(value)
+        if match:
+            return int(match.group(1))
+    return None
+
+
+def to_row(record, table):
+    """
+    Turns a dump object into a row of the table, swapi.tech objects keep their
+    fields under "result" -> "properties"
+    """
+    model, columns = RESOURCES[table]
+    record = record.get("result", record)
+    if "properties" in record:
+        fields = dict(record["properties"])
+        fields.setdefault("description", record.get("description"))
+        fields.setdefault("uid", record.get("uid"))
+    else:
+        fields = record
+    row = {column: fields.get(column) for column in columns}
+    for name in model.numeric_fields:
+        row[name + "_value"] = parse_number(row[name])
+    row["id"] = url_id(fields.get("id") or fields.get("uid") or fields.get("url"))
+    if table == "people":
+        row["homeworld_id"] = fields.get("homeworld")
+    return row
+
+
+def resolve_homeworlds(connection, rows):
+    # urls and ids are used as they are, names are looked up in one query
+    names = set()
+    for row in rows:
+        reference = row["homeworld_id"]
+        if url_id(reference) is None and isinstance(reference, str):
+            names.add(reference)
+    ids = {}
+    if len(names) > 0:
+        result = connection.execute(db.select(Planet.name, Planet.id).where(Planet.name.in_(names)))
+        ids = dict(result.all())
+    for row in rows:
+        reference = row["homeworld_id"]
+        row["homeworld_id"] = url_id(reference) if url_id(reference) is not None else ids.get(reference)
+
+
+def copy_chunk(connection, table, rows, upsert):
+    # PostgreSQL: COPY the chunk into a temporary table, then move it over,
+    # returns the ids of the rows
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(["\\N" if row[c] is None else row[c] for c in columns])
+    buffer.seek(0)
+    column_list = ", ".join(columns)
+    connection.exec_driver_sql("CREATE TEMP TABLE ingest_chunk (LIKE %s INCLUDING DEFAULTS) ON COMMIT DROP" % table)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert("COPY ingest_chunk (%s) FROM STDIN WITH (FORMAT csv, NULL '\\N')" % column_list, buffer)
+    conflict = ""
+    if upsert:
+        updates = ", ".join("%s = EXCLUDED.%s" % (c, c) for c in columns if c != "id")
+        conflict = " ON CONFLICT (id) DO UPDATE SET " + updates
+    ids = connection.exec_driver_sql(
+        "INSERT INTO %s (%s) SELECT %s FROM ingest_chunk%s RETURNING id" % (table, column_list, column_list, conflict)
+    ).scalars().all()
+    # a chunk copies its rows with and without an id in one transaction, each
+    # with its own columns
+    connection.exec_driver_sql("DROP TABLE ingest_chunk")
+    return ids
+
+
+def insert_chunk(connection, table, rows, upsert):
+    model_table = RESOURCES[table][0].__table__
+    dialect = connection.dialect.name
+    if not upsert:
+        connection.execute(model_table.insert(), rows)
+        return
+    columns = [c for c in rows[0] if c != "id"]
+    if dialect == "postgresql":
+        statement = postgresql.insert(model_table)
+        statement = statement.on_conflict_do_update(index_elements=["id"], set_={c: statement.excluded[c] for c in columns})
+    elif dialect == "sqlite":
+        statement = sqlite.insert(model_table)
+        statement = statement.on_conflict_do_update(index_elements=["id"], set_={c: statement.excluded[c] for c in columns})
+    elif dialect in ("mysql", "mariadb"):
+        statement = mysql.insert(model_table)
+        statement = statement.on_duplicate_key_update({c: statement.inserted[c] for c in columns})
+    else:
+        raise click.ClickException("--upsert is not supported on " + dialect)
+    connection.execute(statement, rows)
+
+
+def insert_new_rows(connection, table, rows):
+    """
+    Inserts the rows without an id, returns the ids the database gave them
+    """
+    model_table = RESOURCES[table][0].__table__
+    if connection.dialect.insert_executemany_returning:
+        return connection.execute(model_table.insert().returning(model_table.c.id), rows).scalars().all()
+    # no RETURNING (MySQL): the lock on the end of the id index keeps the
+    # other writers from inserting until the commit, the ids past the
+    # previous maximum are the ones inserted here
+    before = connection.execute(db.select(db.func.max(model_table.c.id)).with_for_update()).scalar() or 0
+    connection.execute(model_table.insert(), rows)
+    return connection.execute(db.select(model_table.c.id).where(model_table.c.id > before)).scalars().all()
+
+
+def load_chunk(engine, table, records, upsert, use_copy):
+    rows = [to_row(record, table) for record in records]
+    # rows without an id get one from the database
+    with_id = [row for row in rows if row["id"] is not None]
+    without_id = [row for row in rows if row["id"] is None]
+    for row in without_id:
+        del row["id"]
+    with engine.begin() as connection:
+        if table == "people":
+            resolve_homeworlds(connection, rows)
+        # the explicit ids already in the table are logged as updates, the
+        # others as creates
+        ids = [row["id"] for row in with_id]
+        existing = set()
+        if len(ids) > 0:
+            model = RESOURCES[table][0]
+            existing = set(connection.execute(db.select(model.id).where(model.id.in_(ids))).scalars())
+        created = []
+        if len(without_id) > 0:
+            if use_copy:
+                created = copy_chunk(connection, table, without_id, False)
+            else:
+                created = insert_new_rows(connection, table, without_id)
+        if len(with_id) > 0:
+            if use_copy:
+                copy_chunk(connection, table, with_id, upsert)
+            else:
+                insert_chunk(connection, table, with_id, upsert)
+        # the version is bumped before the change log is locked, in the same
+        # order as the flushes of the web workers
+        versions.bump(connection, {table})
+        changes.record(
+            connection,
+            [(table, id, "update" if id in existing else "create") for id in ids]
+            + [(table, id, "create") for id in created]
+        )
+        if len(ids) > 0:
+            if table == "planets" and upsert:
+                # people embed the name of their homeworld
+                changes.record_select(connection, "people", db.select(Person.id).where(Person.homeworld_id.in_(ids)), "update")
+    return len(rows)
+
+
+def chunks(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def ingest(table, path, chunk_size=1000, workers=1, upsert=False):
+    engine = db.engine
+    dialect = engine.dialect.name
+    use_copy = dialect == "postgresql" and engine.driver == "psycopg2"
+    if dialect == "sqlite":
+        # sqlite only has one writer at a time
+        workers = 1
+
+    total = 0
+    records = chunks(read_records(path), chunk_size)
+    if workers == 1:
+        for chunk in records:
+            total += load_chunk(engine, table, chunk, upsert, use_copy)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # at most two chunks per worker are held in memory
+            pending = []
+            for chunk in records:
+                pending.append(executor.submit(load_chunk, engine, table, chunk, upsert, use_copy))
+                if len(pending) >= workers * 2:
+                    total += pending.pop(0).result()
+            for future in pending:
+                total += future.result()
+
+    if dialect == "postgresql":
+        with engine.begin() as connection:
+            # explicit ids don't move the sequence forward
+            connection.exec_driver_sql(
+                "SELECT setval(pg_get_serial_sequence('%s', 'id'), COALESCE(MAX(id), 1)) FROM %s" % (table, table)
+            )
+    # only frees the memory of this process, the bumped version keeps the
+    # other processes from reading their entries
+    entity_cache.invalidate_table(table)
+    if table == "planets":
+        entity_cache.invalidate_table("people")
+    return total
+
+
+def init_app(app):
+    @app.cli.command("ingest")
+    @click.argument("table", type=click.Choice(list(RESOURCES)))
+    @click.argument("path", type=click.Path(exists=True, dir_okay=False))
+    @click.option("--chunk-size", default=1000, show_default=True, help="Rows per INSERT/COPY and per transaction.")
+    @click.option("--workers", default=1, show_default=True, help="Chunks loaded in parallel, each on its own connection.")
+    @click.option("--upsert", is_flag=True, help="Update the rows whose id already exists instead of failing.")
+    def ingest_command(table, path, chunk_size, workers, upsert):
+        """Loads a SWAPI-style JSON or NDJSON dump into TABLE"""
+        try:
+            total = ingest(table, path, chunk_size, workers, upsert)
+        except IntegrityError as error:
+            raise click.ClickException(str(error.orig) + " (the chunks before it were loaded, run again with --upsert)")
+        click.echo("Ingested %d %s" % (total, table))
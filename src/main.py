@@ -2,13 +2,25 @@
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
 """
 import os
-from flask import Flask, request, jsonify, url_for
-from flask_migrate import Migrate
-from flask_swagger import swagger
+from flask import Flask, current_app, request, jsonify, url_for
 from flask_cors import CORS
 from utils import APIException, generate_sitemap
-from admin import setup_admin
 from models import db, User, Person, Planet, Vehicle
+import queries
+import includes
+from cache import entity_cache
+import versions
+import snapshot
+import encoders
+from search import search_index
+import favorites
+import changes
+import ingest
+import routing
+import batch
+from metrics import metrics
+from admission import admission
+from compression import compressor
 
 from flask_jwt_extended import create_access_token
 from flask_jwt_extended import get_jwt_identity
@@ -16,33 +28,128 @@ from flask_jwt_extended import jwt_required
 from flask_jwt_extended import JWTManager
 #from models import Person
 
-app = Flask(__name__)
-app.url_map.strict_slashes = False
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_CONNECTION_STRING')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-MIGRATE = Migrate(app, db)
-db.init_app(app)
-CORS(app)
-setup_admin(app)
-
-# Setup the Flask-JWT-Extended extension
-app.config["JWT_SECRET_KEY"] = "super-secret"  # Change this!
-jwt = JWTManager(app)
+# the routes below are collected here and added to every app by create_app
+ROUTES = []
+
+
+def route(rule, **options):
+    def decorator(view):
+        ROUTES.append((rule, options, view))
+        return view
+    return decorator
+
+
+def enabled(value, variable):
+    # the create_app arguments win over the environment
+    if value is None:
+        return os.environ.get(variable, 'true') == 'true'
+    return value
+
+
+def create_app(admin=None, migrate=None, swagger=None):
+    """
+    Builds the app. The admin, the migrations (flask db) and the swagger spec
+    are on unless ENABLE_ADMIN, ENABLE_MIGRATE or ENABLE_SWAGGER are 'false' or
+    the arguments turn them off: API-only workers skip them and never import
+    Flask-Admin, Alembic or flask-swagger.
+    """
+    app = Flask(__name__)
+    app.url_map.strict_slashes = False
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_CONNECTION_STRING')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['ASYNC_DB_CONNECTION_STRING'] = os.environ.get('ASYNC_DB_CONNECTION_STRING')
+    app.config['DB_REPLICA_CONNECTION_STRING'] = os.environ.get('DB_REPLICA_CONNECTION_STRING')
+    app.config['REPLICA_STICKY_SECONDS'] = int(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+    app.config['DB_POOL_SIZE'] = os.environ.get('DB_POOL_SIZE')
+    app.config['DB_MAX_OVERFLOW'] = os.environ.get('DB_MAX_OVERFLOW')
+    app.config['DB_POOL_TIMEOUT'] = os.environ.get('DB_POOL_TIMEOUT')
+    app.config['DB_POOL_RECYCLE'] = os.environ.get('DB_POOL_RECYCLE')
+    app.config['DB_POOL_PRE_PING'] = os.environ.get('DB_POOL_PRE_PING')
+    app.config['MAX_PAGE_SIZE'] = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+    app.config['EXPORT_BATCH_SIZE'] = int(os.environ.get('EXPORT_BATCH_SIZE', 500))
+    app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'memory')
+    app.config['CACHE_MAX_SIZE'] = int(os.environ.get('CACHE_MAX_SIZE', 10000))
+    app.config['CACHE_TTL'] = int(os.environ.get('CACHE_TTL', 300))
+    app.config['CACHE_REDIS_URL'] = os.environ.get('CACHE_REDIS_URL')
+    app.config['JSON_BACKEND'] = os.environ.get('JSON_BACKEND', 'auto')
+    app.config['SNAPSHOT_PATH'] = os.environ.get('SNAPSHOT_PATH')
+    app.config['SNAPSHOT_AUTO_REBUILD'] = os.environ.get('SNAPSHOT_AUTO_REBUILD', 'true') == 'true'
+    app.config['SLOW_REQUEST_MS'] = int(os.environ.get('SLOW_REQUEST_MS', 0))
+    app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+    app.config['COMPRESS_GZIP_LEVEL'] = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+    app.config['COMPRESS_BROTLI_QUALITY'] = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 4))
+    app.config['COMPRESS_CACHE_SIZE'] = int(os.environ.get('COMPRESS_CACHE_SIZE', 256))
+    app.config['BATCH_MAX_REQUESTS'] = int(os.environ.get('BATCH_MAX_REQUESTS', 100))
+    app.config['FAVORITES_INDEX_SIZE'] = int(os.environ.get('FAVORITES_INDEX_SIZE', 10000))
+    app.config['FAVORITES_INDEX_TTL'] = int(os.environ.get('FAVORITES_INDEX_TTL', 60))
+    app.config['CONCURRENCY_LIMIT'] = int(os.environ.get('CONCURRENCY_LIMIT', 0))
+    app.config['CONCURRENCY_LIMITS'] = os.environ.get('CONCURRENCY_LIMITS')
+    app.config['ADMISSION_QUEUE_SIZE'] = int(os.environ.get('ADMISSION_QUEUE_SIZE', 16))
+    app.config['ADMISSION_TIMEOUT_MS'] = int(os.environ.get('ADMISSION_TIMEOUT_MS', 1000))
+    app.config['ADMISSION_DIR'] = os.environ.get('ADMISSION_DIR')
+    app.config['RATE_LIMIT_PER_SECOND'] = float(os.environ.get('RATE_LIMIT_PER_SECOND', 0))
+    app.config['RATE_LIMIT_BURST'] = int(os.environ.get('RATE_LIMIT_BURST', 0))
+    app.config['API_KEYS'] = os.environ.get('API_KEYS')
+    if enabled(migrate, 'ENABLE_MIGRATE'):
+        from flask_migrate import Migrate
+        Migrate(app, db)
+    encoders.init_app(app)
+    metrics.init_app(app)
+    admission.init_app(app)
+    compressor.init_app(app)
+    routing.init_app(app)
+    db.init_app(app)
+    entity_cache.init_app(app)
+    versions.init_app(app)
+    search_index.init_app(app)
+    favorites.init_app(app)
+    changes.init_app(app)
+    snapshot.store.init_app(app)
+    ingest.init_app(app)
+    CORS(app)
+    if enabled(admin, 'ENABLE_ADMIN'):
+        from admin import setup_admin
+        setup_admin(app)
+
+    # Setup the Flask-JWT-Extended extension
+    app.config["JWT_SECRET_KEY"] = "super-secret"  # Change this!
+    JWTManager(app)
+
+    app.register_error_handler(APIException, handle_invalid_usage)
+    for rule, options, view in ROUTES:
+        app.add_url_rule(rule, view_func=view, **options)
+    if enabled(swagger, 'ENABLE_SWAGGER'):
+        app.add_url_rule('/spec', view_func=spec)
+    return app
+
+
+def __getattr__(name):
+    # `from main import app` builds the default app the first time it's used,
+    # wsgi.py and asgi.py call create_app() themselves
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(name)
 
 
 # Handle/serialize errors like a JSON object
-@app.errorhandler(APIException)
 def handle_invalid_usage(error):
-    return jsonify(error.to_dict()), error.status_code
+    return error.to_response()
+
+#Endpoint to describe the API in the swagger format
+def spec():
+    from flask_swagger import swagger
+    return jsonify(swagger(current_app))
 
 # generate sitemap with all your endpoints
-@app.route('/')
+@route('/')
 def sitemap():
-    return generate_sitemap(app)
+    return generate_sitemap(current_app)
 
 # Create a route to authenticate your users and return JWTs. The
 # create_access_token() function is used to actually generate the JWT.
-@app.route("/login", methods=["POST"])
+@route("/login", methods=["POST"])
 def login():
     username = request.json.get("username", None)
     password = request.json.get("password", None)
@@ -56,28 +163,39 @@ def login():
     return jsonify(access_token=access_token)
 
 #Endpoint to retrieve all users
-@app.route('/users', methods=['GET'])
+@route('/users', methods=['GET'])
+@versions.conditional("users", includes.tables)
 def handle_users():
-    users = User.query.all()
+    resource, key, msg = queries.read_route("handle_users")
+    fields = queries.requested_fields(resource)
+    page = queries.paginate(resource, includes.loaded_fields(resource, fields))
     response_body = {
-        "msg": "These are all users",
-        "users": list(map(lambda x:x.serialize(),users))
+        "msg": msg,
+        key: includes.serialize(resource, page.items, fields, queries.serialize_users),
+        "next": page.next_url
     }
 
     return jsonify(response_body), 200
 
+#Endpoint to export all users as newline-delimited JSON
+@route('/users/export', methods=['GET'])
+def export_users():
+    return queries.export(queries.users_for_request(), queries.serialize_users)
+
 #Endpoint to retrieve one user by id
-@app.route('/users/<int:id>', methods=['GET'])
+@route('/users/<int:id>', methods=['GET'])
+@versions.conditional("users", includes.tables)
 def get_user_by_id(id):
-    user = User.query.get(id)
+    resource, key, msg = queries.read_route("get_user_by_id")
+    user = includes.get_serialized(resource, id, queries.serialize_users)
     response_body = {
-        "user": user.serialize()
+        key: user
     }
    
     return jsonify(response_body), 200
 
 #Endpoint to add to favorites
-@app.route('/users', methods=['PUT'])
+@route('/users', methods=['PUT'])
 def update_user_favorites():
     user_id = request.json.get("user_id", None)
     resource_id = request.json.get("id", None)
@@ -90,99 +208,284 @@ def update_user_favorites():
     if resource_type is None:
         return jsonify({"msg": "No resource type specified"}), 400
 
-    user = User.query.get(user_id)
+    favorites.apply_operations(user_id, [{"op": "add", "type": resource_type, "id": resource_id}])
+    user = queries.users.get(user_id)
+
+    response_body = {
+        "msg": "Resource added successfully",
+        "user": user.serialize()
+    }
 
-    if User is None:
-        return jsonify({"msg": "No user was found"}), 400
+    return jsonify(response_body), 200
 
-    if resource_type == "person":
-        resource = Person.query.get(resource_id)
-        user.people.append(resource)
-    if resource_type == "planet":
-        resource = Planet.query.get(resource_id)
-        user.planets.append(resource)
+#Endpoint to add and remove many favorites at once
+@route('/users/<int:id>/favorites', methods=['POST'])
+def update_many_user_favorites(id):
+    body = request.get_json()
+    if body is None or "operations" not in body:
+        raise APIException("You need to specify the operations", status_code=400)
 
-    if resource_type == "vehicle":
-        resource = Vehicle.query.get(resource_id)
-        user.vehicles.append(resource)
+    favorites.apply_operations(id, body["operations"])
+    response_body = {
+        "msg": "Favorites updated successfully",
+        "user": queries.users_summary.get(id).serialize(queries.favorite_ids([id])[id])
+    }
 
-    db.session.commit()
+    return jsonify(response_body), 200
 
+#Endpoint to retrieve the favorites of the logged in user
+@route('/me/favorites', methods=['GET'])
+@jwt_required()
+def get_my_favorites():
+    user_id, favorite_pairs = favorites.favorites_index.get(get_jwt_identity())
     response_body = {
-        "msg": "Resource added successfully",
-        "user": user.serialize()
+        "msg": "These are your favorites",
+        "favorites": favorites.serialize_ids(favorite_pairs)
+    }
+
+    return jsonify(response_body), 200
+
+#Endpoint to add and remove many favorites of the logged in user
+@route('/me/favorites', methods=['POST'])
+@jwt_required()
+def update_my_favorites():
+    body = request.get_json()
+    if body is None or "operations" not in body:
+        raise APIException("You need to specify the operations", status_code=400)
+
+    favorites.apply_operations(favorites.user_id_of(get_jwt_identity()), body["operations"])
+    user_id, favorite_pairs = favorites.favorites_index.get(get_jwt_identity())
+    response_body = {
+        "msg": "Favorites updated successfully",
+        "favorites": favorites.serialize_ids(favorite_pairs)
+    }
+
+    return jsonify(response_body), 200
+
+#Endpoint to check if something is a favorite of the logged in user
+@route('/me/favorites/<resource_type>/<int:id>', methods=['GET'])
+@jwt_required()
+def get_my_favorite(resource_type, id):
+    resource_type = favorites.favorite_type(resource_type)
+    user_id, favorite_pairs = favorites.favorites_index.get(get_jwt_identity())
+    response_body = {
+        "type": resource_type,
+        "id": id,
+        "favorite": (resource_type, id) in favorite_pairs
+    }
+
+    return jsonify(response_body), 200
+
+#Endpoint to add or remove one favorite of the logged in user
+@route('/me/favorites/<resource_type>/<int:id>', methods=['PUT', 'DELETE'])
+@jwt_required()
+def update_my_favorite(resource_type, id):
+    resource_type = favorites.favorite_type(resource_type)
+    user_id = favorites.user_id_of(get_jwt_identity())
+    op = "add" if request.method == "PUT" else "remove"
+    favorites.apply_operations(user_id, [{"op": op, "type": resource_type, "id": id}])
+    response_body = {
+        "type": resource_type,
+        "id": id,
+        "favorite": op == "add"
     }
 
     return jsonify(response_body), 200
 
 #Endpoint to retrieve all characters
-@app.route('/people', methods=['GET'])
+@route('/people', methods=['GET'])
+@versions.conditional("people", includes.tables)
+@snapshot.serve("people")
 def get_people():
-    people = Person.query.all()
+    resource, key, msg = queries.read_route("get_people")
+    fields = queries.requested_fields(resource)
+    page = queries.paginate(resource, includes.loaded_fields(resource, fields))
     response_body = {
-        "msg": "These are characters",
-        "people": list(map(lambda x:x.serialize(), people))
+        "msg": msg,
+        key: includes.serialize(resource, page.items, fields),
+        "next": page.next_url
+    }
+
+    return jsonify(response_body), 200
+
+#Endpoint to export all characters as newline-delimited JSON
+@route('/people/export', methods=['GET'])
+def export_people():
+    return queries.export(queries.people)
+
+#Endpoint to retrieve the most favorited characters
+@route('/people/popular', methods=['GET'])
+def get_popular_people():
+    fields = queries.requested_fields(queries.people)
+    people = favorites.popular(queries.people, queries.page_limit(20), fields)
+    response_body = {
+        "msg": "These are the most favorited characters",
+        "people": favorites.serialize_popular(people, fields)
     }
 
     return jsonify(response_body), 200
 
 #Endpoint to retrieve one character by id
-@app.route('/people/<int:id>', methods=['GET'])
+@route('/people/<int:id>', methods=['GET'])
+@versions.conditional("people", includes.tables)
+@snapshot.serve("people")
 def get_person_by_id(id):
-    person = Person.query.get(id)
+    resource, key, msg = queries.read_route("get_person_by_id")
+    person = includes.get_serialized(resource, id)
     response_body = {
-        "msg": "This is a character",
-        "person": person.serialize()
+        "msg": msg,
+        key: person
     }
    
     return jsonify(response_body), 200
 
 #Endpoint to retrieve planets
-@app.route('/planets', methods=['GET'])
+@route('/planets', methods=['GET'])
+@versions.conditional("planets", includes.tables)
+@snapshot.serve("planets")
 def get_planets():
-    planets = Planet.query.all()
+    resource, key, msg = queries.read_route("get_planets")
+    fields = queries.requested_fields(resource)
+    page = queries.paginate(resource, includes.loaded_fields(resource, fields))
+    response_body = {
+        "msg": msg,
+        key: includes.serialize(resource, page.items, fields),
+        "next": page.next_url
+    }
+
+    return jsonify(response_body), 200
+
+#Endpoint to export all planets as newline-delimited JSON
+@route('/planets/export', methods=['GET'])
+def export_planets():
+    return queries.export(queries.planets)
+
+#Endpoint to retrieve the most favorited planets
+@route('/planets/popular', methods=['GET'])
+def get_popular_planets():
+    fields = queries.requested_fields(queries.planets)
+    planets = favorites.popular(queries.planets, queries.page_limit(20), fields)
     response_body = {
-        "msg": "These are planets", 
-        "planets": list(map(lambda x:x.serialize(), planets))
+        "msg": "These are the most favorited planets",
+        "planets": favorites.serialize_popular(planets, fields)
     }
 
     return jsonify(response_body), 200
 
 #Endpoint to retrieve one planet by id
-@app.route('/planets/<int:id>', methods=['GET'])
+@route('/planets/<int:id>', methods=['GET'])
+@versions.conditional("planets", includes.tables)
+@snapshot.serve("planets")
 def get_planet_by_id(id):
-    planet = Planet.query.get(id)
+    resource, key, msg = queries.read_route("get_planet_by_id")
+    planet = includes.get_serialized(resource, id)
     response_body = {
-        "msg": "This is a planet", 
-        "planet": planet.serialize()
+        "msg": msg,
+        key: planet
     }
 
     return jsonify(response_body), 200
 
 #Endpoint to retrieve all vehicles
-@app.route('/vehicles', methods=['GET'])
+@route('/vehicles', methods=['GET'])
+@versions.conditional("vehicles", includes.tables)
+@snapshot.serve("vehicles")
 def get_vehicles():
-    vehicles = Vehicle.query.all()
+    resource, key, msg = queries.read_route("get_vehicles")
+    fields = queries.requested_fields(resource)
+    page = queries.paginate(resource, includes.loaded_fields(resource, fields))
     response_body = {
-        "msg": "These are vehicles", 
-        "vehicles": list(map(lambda x:x.serialize(), vehicles))
+        "msg": msg,
+        key: includes.serialize(resource, page.items, fields),
+        "next": page.next_url
+    }
+
+    return jsonify(response_body), 200
+
+#Endpoint to export all vehicles as newline-delimited JSON
+@route('/vehicles/export', methods=['GET'])
+def export_vehicles():
+    return queries.export(queries.vehicles)
+
+#Endpoint to retrieve the most favorited vehicles
+@route('/vehicles/popular', methods=['GET'])
+def get_popular_vehicles():
+    fields = queries.requested_fields(queries.vehicles)
+    vehicles = favorites.popular(queries.vehicles, queries.page_limit(20), fields)
+    response_body = {
+        "msg": "These are the most favorited vehicles",
+        "vehicles": favorites.serialize_popular(vehicles, fields)
     }
 
     return jsonify(response_body), 200
 
 #Endpoint to retrieve one vehicle by id
-@app.route('/vehicles/<int:id>', methods=['GET'])
+@route('/vehicles/<int:id>', methods=['GET'])
+@versions.conditional("vehicles", includes.tables)
+@snapshot.serve("vehicles")
 def get_vehicle_by_id(id):
-    vehicle = Vehicle.query.get(id)
+    resource, key, msg = queries.read_route("get_vehicle_by_id")
+    vehicle = includes.get_serialized(resource, id)
+    response_body = {
+        "msg": msg,
+        key: vehicle
+    }
+
+    return jsonify(response_body), 200
+
+
+#Endpoint to search people, planets and vehicles by name and description
+@route('/search', methods=['GET'])
+def search():
+    q = request.args.get("q", "").strip()
+    if q == "":
+        raise APIException("You need to specify the search terms with ?q=", status_code=400)
+    limit = queries.page_limit()
+    offset = 0
+    cursor = request.args.get("cursor")
+    if cursor:
+        offset = queries.decode_cursor(cursor).get("offset")
+        if not isinstance(offset, int) or offset < 0:
+            raise APIException("Invalid cursor", status_code=400)
+
+    results = search_index.search(q)
+    next_url = None
+    if offset + limit < len(results):
+        next_url = url_for("search", q=q, limit=limit, cursor=queries.encode_cursor({"offset": offset + limit}))
     response_body = {
-        "msg": "This is a vehicle", 
-        "vehicle": vehicle.serialize()
+        "msg": "These are the search results",
+        "total": len(results),
+        "results": list(map(search_index.serialize_result, results[offset:offset + limit])),
+        "next": next_url
     }
 
     return jsonify(response_body), 200
 
+#Endpoint to run several GET requests in one round trip
+@route('/batch', methods=['POST'])
+def run_batch():
+    return batch.run()
+
+#Endpoint to retrieve the changes to the catalog after a seq
+@route('/changes', methods=['GET'])
+def get_changes():
+    items, last_seq, next_url = changes.changes_since()
+    response_body = {
+        "msg": "These are the changes",
+        "changes": items,
+        "last_seq": last_seq,
+        "next": next_url
+    }
+
+    return jsonify(response_body), 200
+
+#Endpoint to expose the request metrics in the Prometheus format
+@route('/metrics', methods=['GET'])
+def get_metrics():
+    return metrics.render()
+
 
 # this only runs if `$ python src/main.py` is executed
 if __name__ == '__main__':
     PORT = int(os.environ.get('PORT', 3000))
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    create_app().run(host='0.0.0.0', port=PORT, debug=False)
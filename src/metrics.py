@@ -0,0 +1,186 @@
+"""
+Per-request instrumentation: every request records its database time, number
+of SQL statements, serialization time and response size. They are sent back in
+a Server-Timing header and aggregated per endpoint into histograms exposed in
+the Prometheus text format on /metrics. The histograms are kept per worker
+process, Prometheus sums the workers it scrapes.
+
+SLOW_REQUEST_MS logs the requests slower than that with the SQL they ran.
+"""
+import threading
+import time
+from flask import Response, current_app, g, has_request_context, request
+from sqlalchemy.engine import Engine
+from utils import listen_once
+from cache import entity_cache
+from compression import compressor
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# name, help and buckets of each histogram
+HISTOGRAMS = {
+    "request_duration_seconds": ("Time spent handling the request", DURATION_BUCKETS),
+    "request_db_seconds": ("Time spent running SQL statements", DURATION_BUCKETS),
+    "request_sql_statements": ("SQL statements run by the request", STATEMENT_BUCKETS),
+    "request_serialize_seconds": ("Time spent encoding the JSON body", DURATION_BUCKETS),
+    "response_size_bytes": ("Size of the response body", SIZE_BUCKETS),
+}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+def current():
+    if has_request_context():
+        return g.get("metrics")
+    return None
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    metrics = current()
+    if metrics is None:
+        return
+    metrics["db"] += elapsed
+    metrics["statements"] += 1
+    if metrics["sql"] is not None:
+        metrics["sql"].append((elapsed, statement))
+
+
+class Metrics:
+    def __init__(self):
+        self.histograms = {}
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        """
+        Must be called after encoders.init_app, the JSON provider is wrapped
+        to time the serialization
+        """
+        listen_once(Engine, "before_cursor_execute", before_cursor_execute)
+        listen_once(Engine, "after_cursor_execute", after_cursor_execute)
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+        response = app.json.response
+
+        def timed_response(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return response(*args, **kwargs)
+            finally:
+                metrics = current()
+                if metrics is not None:
+                    metrics["serialize"] += time.perf_counter() - start
+
+        app.json.response = timed_response
+
+    def before_request(self):
+        g.metrics = {
+            "start": time.perf_counter(),
+            "db": 0,
+            "statements": 0,
+            "serialize": 0,
+            # the SQL is only kept when the slow request log is on
+            "sql": [] if current_app.config.get("SLOW_REQUEST_MS") else None,
+        }
+
+    def after_request(self, response):
+        metrics = g.pop("metrics", None)
+        if metrics is None:
+            return response
+        total = time.perf_counter() - metrics["start"]
+        response.headers["Server-Timing"] = 'db;dur=%.2f;desc="%d statements", serialize;dur=%.2f, total;dur=%.2f' % (
+            metrics["db"] * 1000, metrics["statements"], metrics["serialize"] * 1000, total * 1000
+        )
+        # the size of streamed responses isn't known yet
+        size = response.content_length
+        if size is None and not response.is_streamed:
+            size = len(response.get_data())
+
+        endpoint = request.endpoint or "not_found"
+        values = {
+            "request_duration_seconds": total,
+            "request_db_seconds": metrics["db"],
+            "request_sql_statements": metrics["statements"],
+            "request_serialize_seconds": metrics["serialize"],
+            "response_size_bytes": size,
+        }
+        with self.lock:
+            for name, value in values.items():
+                if value is None:
+                    continue
+                key = (name, endpoint)
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(HISTOGRAMS[name][1])
+                self.histograms[key].observe(value)
+            key = (endpoint, request.method, response.status_code)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+        slow = current_app.config.get("SLOW_REQUEST_MS")
+        if slow and total * 1000 >= slow:
+            lines = ["%.2fms %s" % (elapsed * 1000, statement) for elapsed, statement in metrics["sql"]]
+            current_app.logger.warning(
+                "Slow request %s %s: %.2fms, %d statements (%.2fms)\n%s",
+                request.method, request.full_path, total * 1000, metrics["statements"], metrics["db"] * 1000, "\n".join(lines)
+            )
+        return response
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = [
+            "# HELP http_requests_total Requests handled by this worker",
+            "# TYPE http_requests_total counter",
+        ]
+        with self.lock:
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append('http_requests_total{endpoint="%s",method="%s",status="%d"} %d' % (endpoint, method, status, count))
+            for name, (help, buckets) in HISTOGRAMS.items():
+                lines.append("# HELP http_%s %s" % (name, help))
+                lines.append("# TYPE http_%s histogram" % name)
+                for (histogram_name, endpoint), histogram in sorted(self.histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append('http_%s_bucket{endpoint="%s",le="%s"} %d' % (name, endpoint, bound, count))
+                    lines.append('http_%s_bucket{endpoint="%s",le="+Inf"} %d' % (name, endpoint, histogram.count))
+                    lines.append('http_%s_sum{endpoint="%s"} %s' % (name, endpoint, repr(float(histogram.sum))))
+                    lines.append('http_%s_count{endpoint="%s"} %d' % (name, endpoint, histogram.count))
+        stats = entity_cache.stats()
+        lines += [
+            "# HELP compression_cache_hits_total Compressed bodies reused from the cache",
+            "# TYPE compression_cache_hits_total counter",
+            "compression_cache_hits_total %d" % compressor.hits,
+            "# HELP compression_cache_misses_total Bodies compressed",
+            "# TYPE compression_cache_misses_total counter",
+            "compression_cache_misses_total %d" % compressor.misses,
+            "# HELP entity_cache_hits_total Entity cache hits",
+            "# TYPE entity_cache_hits_total counter",
+            "entity_cache_hits_total %d" % stats["hits"],
+            "# HELP entity_cache_misses_total Entity cache misses",
+            "# TYPE entity_cache_misses_total counter",
+            "entity_cache_misses_total %d" % stats["misses"],
+        ]
+        return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+metrics = Metrics()
@@ -1,20 +1,39 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import validates
+from routing import RoutingSession
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+
+def parse_number(value):
+    """
+    Numeric value of the free-form catalog strings: "1,000" -> 1000.0,
+    "unknown", "n/a" or ranges like "30-165" -> None
+    """
+    if value is None:
+        return None
+    try:
+        return float(str(value).replace(",", "").strip())
+    except ValueError:
+        return None
 
-db = SQLAlchemy()
 
 favorite_people = db.Table('user_people', db.Model.metadata,
     db.Column('user_id', db.Integer, db.ForeignKey('users.id'), primary_key=True),
-    db.Column('person_id', db.Integer, db.ForeignKey('people.id'), primary_key=True)
+    # reverse lookup: which users favorited this person
+    db.Column('person_id', db.Integer, db.ForeignKey('people.id'), primary_key=True, index=True)
 )
 
 favorite_planets = db.Table('user_planets', db.Model.metadata,
     db.Column('user_id', db.Integer, db.ForeignKey('users.id'), primary_key=True),
-    db.Column('planet_id', db.Integer, db.ForeignKey('planets.id'), primary_key=True)
+    # reverse lookup: which users favorited this planet
+    db.Column('planet_id', db.Integer, db.ForeignKey('planets.id'), primary_key=True, index=True)
 )
 
 favorite_vehicles = db.Table('user_vehicles', db.Model.metadata,
     db.Column('user_id', db.Integer, db.ForeignKey('users.id'), primary_key=True),
-    db.Column('vehicle_id', db.Integer, db.ForeignKey('vehicles.id'), primary_key=True)
+    # reverse lookup: which users favorited this vehicle
+    db.Column('vehicle_id', db.Integer, db.ForeignKey('vehicles.id'), primary_key=True, index=True)
 )
 
 class User(db.Model):
@@ -32,20 +51,41 @@ class User(db.Model):
     def __repr__(self):
         return '<User %r>' % self.name
 
-    def serialize(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "username": self.username,
-            "email": self.email,
-            "favorite_people": list(map(lambda x:x.serialize(), self.people)),
-            "favorite_planets": list(map(lambda x:x.serialize(), self.planets)),
-            "favorite_vehicles": list(map(lambda x:x.serialize(), self.vehicles))
-            # do not serialize the password, its a security breach
-        }
-
-
-class Person(db.Model):
+    # do not serialize the password, its a security breach
+    serialize_fields = ("id", "name", "username", "email", "favorite_people", "favorite_planets", "favorite_vehicles")
+
+    def serialize(self, favorite_ids=None, fields=None):
+        # favorite_ids is a {"people": [...], "planets": [...], "vehicles": [...]}
+        # dict, when given the favorites are returned as id lists instead of objects
+        result = {}
+        for name in fields or self.serialize_fields:
+            if name.startswith("favorite_"):
+                relationship = name[len("favorite_"):]
+                if favorite_ids is not None:
+                    result[name] = favorite_ids[relationship]
+                else:
+                    result[name] = list(map(lambda x:x.serialize(), getattr(self, relationship)))
+            else:
+                result[name] = getattr(self, name)
+        return result
+
+
+class Serializer:
+    # the keys of serialize(), in order
+    serialize_fields = ()
+    # string columns that have a <name>_value numeric shadow column, used to
+    # filter and sort by value
+    numeric_fields = ()
+
+    def serialize(self, fields=None):
+        # only the requested fields are read, the others may not even be loaded
+        return {name: self.serialize_field(name) for name in fields or self.serialize_fields}
+
+    def serialize_field(self, name):
+        return getattr(self, name)
+
+
+class Person(Serializer, db.Model):
     __tablename__ = "people"
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(250), nullable=False)
@@ -60,26 +100,32 @@ class Person(db.Model):
     description = db.Column(db.String(800))
     photo_url = db.Column(db.String(250))
 
+    # numeric copies of the columns above, kept in sync by validate_numeric
+    height_value = db.Column(db.Float, index=True)
+    mass_value = db.Column(db.Float, index=True)
+
+    # number of users that have it as favorite, kept up to date by favorites.py
+    favorite_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    __table_args__ = (db.Index("ix_people_favorite_count", "favorite_count", "id"),)
+
     def __repr__(self):
         return '<Person %r>' % self.name
 
-    def serialize(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "height": self.height,
-            "mass": self.mass,
-            "hair_color": self.hair_color,
-            "skin_color": self.skin_color,
-            "eye_color": self.eye_color,
-            "birth_year": self.birth_year,
-            "gender": self.gender,
-            "homeworld": self.homeworld.name,
-            "description": self.description,
-            "photo_url": self.photo_url
-        }
-
-class Planet(db.Model):
+    numeric_fields = ("height", "mass")
+
+    @validates(*numeric_fields)
+    def validate_numeric(self, key, value):
+        setattr(self, key + "_value", parse_number(value))
+        return value
+
+    serialize_fields = ("id", "name", "height", "mass", "hair_color", "skin_color", "eye_color", "birth_year", "gender", "homeworld", "description", "photo_url")
+
+    def serialize_field(self, name):
+        if name == "homeworld":
+            return self.homeworld.name
+        return getattr(self, name)
+
+class Planet(Serializer, db.Model):
     __tablename__ = "planets"
     id = db.Column(db.Integer, primary_key=True)
     characters = db.relationship("Person", backref='homeworld', lazy=True)
@@ -95,26 +141,30 @@ class Planet(db.Model):
     description = db.Column(db.String(800))
     photo_url = db.Column(db.String(250))
 
+    # numeric copies of the columns above, kept in sync by validate_numeric
+    diameter_value = db.Column(db.Float, index=True)
+    rotation_period_value = db.Column(db.Float, index=True)
+    orbital_period_value = db.Column(db.Float, index=True)
+    population_value = db.Column(db.Float, index=True)
+    surface_water_value = db.Column(db.Float, index=True)
+
+    # number of users that have it as favorite, kept up to date by favorites.py
+    favorite_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    __table_args__ = (db.Index("ix_planets_favorite_count", "favorite_count", "id"),)
+
     def __repr__(self):
         return '<Planet %r>' % self.name
 
-    def serialize(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "diameter": self.diameter,
-            "rotation_period": self.rotation_period,
-            "orbital_period": self.orbital_period,
-            "gravity": self.gravity,
-            "population": self.population,
-            "climate": self.climate,
-            "terrain": self.terrain,
-            "surface_water": self.surface_water,
-            "description": self.description,
-            "photo_url": self.photo_url
-        }
-
-class Vehicle(db.Model):
+    numeric_fields = ("diameter", "rotation_period", "orbital_period", "population", "surface_water")
+
+    @validates(*numeric_fields)
+    def validate_numeric(self, key, value):
+        setattr(self, key + "_value", parse_number(value))
+        return value
+
+    serialize_fields = ("id", "name", "diameter", "rotation_period", "orbital_period", "gravity", "population", "climate", "terrain", "surface_water", "description", "photo_url")
+
+class Vehicle(Serializer, db.Model):
     __tablename__ = "vehicles"
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(250), nullable=False)
@@ -131,23 +181,52 @@ class Vehicle(db.Model):
     description = db.Column(db.String(800))
     photo_url = db.Column(db.String(250))
 
+    # numeric copies of the columns above, kept in sync by validate_numeric
+    cost_in_credits_value = db.Column(db.Float, index=True)
+    length_value = db.Column(db.Float, index=True)
+    crew_value = db.Column(db.Float, index=True)
+    passengers_value = db.Column(db.Float, index=True)
+    max_atmosphering_speed_value = db.Column(db.Float, index=True)
+    cargo_capacity_value = db.Column(db.Float, index=True)
+
+    # number of users that have it as favorite, kept up to date by favorites.py
+    favorite_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    __table_args__ = (db.Index("ix_vehicles_favorite_count", "favorite_count", "id"),)
+
     def __repr__(self):
         return '<Vehicle %r>' % self.name
 
-    def serialize(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "model": self.model,
-            "vehicle_class": self.vehicle_class,
-            "manufacturer": self.manufacturer,
-            "cost_in_credits": self.cost_in_credits,
-            "length": self.length,
-            "crew": self.crew,
-            "passengers": self.passengers,
-            "max_atmosphering_speed": self.max_atmosphering_speed,
-            "cargo_capacity": self.cargo_capacity,
-            "consumables": self.consumables,
-            "description": self.description,
-            "photo_url": self.photo_url
-        }
+    numeric_fields = ("cost_in_credits", "length", "crew", "passengers", "max_atmosphering_speed", "cargo_capacity")
+
+    @validates(*numeric_fields)
+    def validate_numeric(self, key, value):
+        setattr(self, key + "_value", parse_number(value))
+        return value
+
+    serialize_fields = ("id", "name", "model", "vehicle_class", "manufacturer", "cost_in_credits", "length", "crew", "passengers", "max_atmosphering_speed", "cargo_capacity", "consumables", "description", "photo_url")
+
+
+class TableVersion(db.Model):
+    # bumped every time a row of the table is written, used for the ETags
+    __tablename__ = "table_versions"
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return '<TableVersion %r>' % self.name
+
+
+class Change(db.Model):
+    # one created, updated or deleted row of the catalog, see changes.py
+    __tablename__ = "change_log"
+    seq = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(50), nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(10), nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False)
+    # sqlite would reuse the seq of deleted rows without it
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    def __repr__(self):
+        return '<Change %r>' % self.seq
@@ -0,0 +1,455 @@
+"""
+Query layer: every route loads its rows through one of the resource queries
+below so the relationship loading strategy is declared in one place and the
+number of SQL statements per request does not depend on the number of rows.
+"""
+import base64
+import binascii
+import json
+from sqlalchemy.orm import configure_mappers, joinedload, load_only, selectinload
+from flask import Response, current_app, request, stream_with_context, url_for
+from utils import APIException
+from cache import entity_cache
+import versions
+from models import db, User, Person, Planet, Vehicle, favorite_people, favorite_planets, favorite_vehicles
+
+# backrefs such as Person.homeworld only exist once the mappers are configured
+configure_mappers()
+
+
+class ResourceQuery:
+    def __init__(self, model, name, options=(), relationships=None, foreign_keys=()):
+        self.model = model
+        self.name = name
+        self.table = model.__tablename__
+        # options used to load the whole row
+        self.options = list(options)
+        # options used to load a relationship field when ?fields= is given
+        self.relationships = relationships or {}
+        # columns always loaded with ?fields=, includes.py follows them
+        self.foreign_keys = list(foreign_keys)
+
+    def loader_options(self, fields=None, extra_columns=()):
+        """
+        Only the columns and relationships behind the requested fields are
+        selected, the rest of the row is never read from the database
+        """
+        if fields is None:
+            return self.options
+        columns = [getattr(self.model, name) for name in fields if name in self.model.__table__.columns]
+        options = [load_only(self.model.id, *self.foreign_keys, *columns, *extra_columns)]
+        for name in fields:
+            if name in self.relationships:
+                options.append(self.relationships[name])
+        return options
+
+    def query(self, fields=None, extra_columns=()):
+        return self.model.query.options(*self.loader_options(fields, extra_columns))
+
+    def statement(self, fields=None, extra_columns=()):
+        # the same as query() as a select, for the async session of asgi.py
+        return db.select(self.model).options(*self.loader_options(fields, extra_columns))
+
+    def sort_column(self, field):
+        if field == "id":
+            return self.model.id
+        return getattr(self.model, field + "_value")
+
+    def page_statement(self, limit, position=None, fields=None, filters=(), sort=("id", False)):
+        """
+        Keyset pagination on (sort column, id): deep pages cost the same as the
+        first one because the index seeks straight past the last row of the
+        previous page (no OFFSET). position is that last row as returned by
+        page_result for the previous page. Rows without a value are left out
+        when sorting by a numeric field. One extra row is selected to know if
+        there is a next page.
+        """
+        field, descending = sort
+        column = self.sort_column(field)
+        extra_columns = []
+        if field != "id":
+            extra_columns.append(column)
+        statement = self.statement(fields, extra_columns).where(*filters)
+        if field != "id":
+            statement = statement.where(column.isnot(None))
+
+        if position is not None:
+            if field == "id":
+                after = column < position["id"] if descending else column > position["id"]
+            elif descending:
+                after = db.or_(column < position["value"], db.and_(column == position["value"], self.model.id < position["id"]))
+            else:
+                after = db.or_(column > position["value"], db.and_(column == position["value"], self.model.id > position["id"]))
+            statement = statement.where(after)
+
+        order = [column, self.model.id]
+        if descending:
+            order = [column.desc(), self.model.id.desc()]
+        if field == "id":
+            order = order[:1]
+        return statement.order_by(*order).limit(limit + 1)
+
+    def page_result(self, items, limit, sort=("id", False)):
+        """
+        Returns the rows of the page and the next position, None on the last
+        page
+        """
+        if len(items) <= limit:
+            return items, None
+        items = items[:limit]
+        position = {"id": items[-1].id}
+        if sort[0] != "id":
+            position["value"] = getattr(items[-1], sort[0] + "_value")
+        return items, position
+
+    def page(self, limit, position=None, fields=None, filters=(), sort=("id", False)):
+        statement = self.page_statement(limit, position, fields, filters, sort)
+        items = db.session.execute(statement).scalars().all()
+        return self.page_result(items, limit, sort)
+
+    def batches(self, batch_size, fields=None):
+        """
+        Iterates over the whole table in lists of batch_size rows, the rows are
+        fetched from a server-side cursor so only one batch is held in memory
+        """
+        statement = (
+            db.select(self.model)
+            .options(*self.loader_options(fields))
+            .order_by(self.model.id)
+            .execution_options(stream_results=True, yield_per=batch_size)
+        )
+        return db.session.execute(statement).scalars().partitions()
+
+    def many_statement(self, ids, fields=None, filters=()):
+        return self.statement(fields).where(self.model.id.in_(ids), *filters)
+
+    def in_order(self, items, ids):
+        # the rows in the order of ids, the ids that don't exist are left out
+        by_id = {item.id: item for item in items}
+        return [by_id[id] for id in ids if id in by_id]
+
+    def many(self, ids, fields=None, filters=()):
+        """
+        The rows of many ids with one IN query, in the order of ids
+        """
+        items = db.session.execute(self.many_statement(ids, fields, filters)).scalars().all()
+        return self.in_order(items, ids)
+
+    def get_statement(self, id, fields=None):
+        return self.statement(fields).where(self.model.id == id).limit(1)
+
+    def get(self, id, fields=None):
+        return self.found(db.session.execute(self.get_statement(id, fields)).scalars().first())
+
+    def found(self, item):
+        if item is None:
+            raise APIException("No " + self.name + " was found", status_code=404)
+        return item
+
+
+class Page:
+    def __init__(self, items, next_url):
+        self.items = items
+        self.next_url = next_url
+
+
+def encode_cursor(position):
+    raw = json.dumps(position, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (ValueError, binascii.Error):
+        raise APIException("Invalid cursor", status_code=400)
+    if not isinstance(position, dict):
+        raise APIException("Invalid cursor", status_code=400)
+    return position
+
+
+def cursor_position(cursor, sort):
+    position = decode_cursor(cursor)
+    if not isinstance(position.get("id"), int):
+        raise APIException("Invalid cursor", status_code=400)
+    if sort[0] != "id" and not isinstance(position.get("value"), (int, float)):
+        raise APIException("The cursor does not match the sort", status_code=400)
+    return position
+
+
+def page_limit(default=None):
+    # clients that do not send ?limit= get the largest page allowed
+    max_size = current_app.config["MAX_PAGE_SIZE"]
+    limit = request.args.get("limit", default or max_size)
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise APIException("limit must be a number", status_code=400)
+    if limit < 1 or limit > max_size:
+        raise APIException("limit must be between 1 and " + str(max_size), status_code=400)
+    return limit
+
+
+def requested_fields(resource):
+    """
+    Reads ?fields=id,name from the request, returns None when all the fields
+    are wanted
+    """
+    fields = request.args.get("fields")
+    if not fields:
+        return None
+    fields = [name.strip() for name in fields.split(",") if name.strip()]
+    for name in fields:
+        if name not in resource.model.serialize_fields:
+            raise APIException("Unknown field " + name, status_code=400)
+    return fields
+
+
+def requested_ids():
+    """
+    Reads ?ids=3,1,2 from the request, returns the ids without duplicates in
+    the order given or None when there is no ?ids=
+    """
+    ids = request.args.get("ids")
+    if ids is None:
+        return None
+    try:
+        ids = [int(id) for id in ids.split(",") if id.strip()]
+    except ValueError:
+        raise APIException("ids must be a comma separated list of numbers", status_code=400)
+    max_size = current_app.config["MAX_PAGE_SIZE"]
+    if len(ids) > max_size:
+        raise APIException("At most " + str(max_size) + " ids can be requested", status_code=400)
+    return list(dict.fromkeys(ids))
+
+
+def requested_filters(resource):
+    """
+    Reads range filters on the numeric fields like ?mass_gte=80&mass_lt=100
+    and returns them as SQL conditions on the indexed shadow columns
+    """
+    operators = {
+        "gt": lambda column, value: column > value,
+        "gte": lambda column, value: column >= value,
+        "lt": lambda column, value: column < value,
+        "lte": lambda column, value: column <= value,
+    }
+    numeric_fields = getattr(resource.model, "numeric_fields", ())
+    filters = []
+    for key, value in request.args.items():
+        field, _, operator = key.rpartition("_")
+        if field not in numeric_fields or operator not in operators:
+            continue
+        try:
+            value = float(value)
+        except ValueError:
+            raise APIException(key + " must be a number", status_code=400)
+        filters.append(operators[operator](resource.sort_column(field), value))
+    return filters
+
+
+def requested_sort(resource):
+    """
+    Reads ?sort=population (ascending) or ?sort=-population (descending),
+    returns a (field, descending) tuple
+    """
+    sort = request.args.get("sort", "id")
+    descending = sort.startswith("-")
+    field = sort.lstrip("-")
+    if field != "id" and field not in getattr(resource.model, "numeric_fields", ()):
+        raise APIException("Can not sort by " + field, status_code=400)
+    return field, descending
+
+
+def page_arguments(resource):
+    """
+    Reads ?limit=, ?cursor=, ?sort= and the range filters from the request,
+    returns the (limit, position, filters, sort) of ResourceQuery.page
+    """
+    limit = page_limit()
+    filters = requested_filters(resource)
+    sort = requested_sort(resource)
+    position = None
+    cursor = request.args.get("cursor")
+    if cursor:
+        position = cursor_position(cursor, sort)
+    return limit, position, filters, sort
+
+
+def next_page_url(limit, position):
+    # the following page keeps the same query string
+    if position is None:
+        return None
+    args = request.args.to_dict()
+    args["cursor"] = encode_cursor(position)
+    args["limit"] = limit
+    return url_for(request.endpoint, **args)
+
+
+def paginate(resource, fields=None):
+    """
+    Returns the Page of the resource asked for by the request, its next_url
+    points to the following page. With ?ids= the page holds those rows in
+    that order.
+    """
+    ids = requested_ids()
+    if ids is not None:
+        return Page(resource.many(ids, fields, requested_filters(resource)), None)
+    limit, position, filters, sort = page_arguments(resource)
+    items, position = resource.page(limit, position, fields, filters, sort)
+    return Page(items, next_page_url(limit, position))
+
+
+def serialize_items(items, fields=None):
+    # whole rows are serialized by the JSON encoder itself
+    if fields is None:
+        return items
+    return list(map(lambda x:x.serialize(fields=fields), items))
+
+
+def get_serialized(resource, id):
+    """
+    Serialized row for the detail routes, whole rows are read through the
+    entity cache, rows restricted with ?fields= are loaded partially
+    """
+    fields = requested_fields(resource)
+    if fields is not None:
+        return resource.get(id, fields).serialize(fields)
+    return entity_cache.get(resource.table, id, lambda: resource.get(id).serialize(), versions.cache_version(resource.table))
+
+
+def export(resource, serialize=serialize_items):
+    """
+    Streams the whole table as newline-delimited JSON, the first rows are sent
+    while the rest of the table is still being read
+    """
+    batch_size = current_app.config["EXPORT_BATCH_SIZE"]
+    dumps_bytes = current_app.json.dumps_bytes
+    fields = requested_fields(resource)
+
+    def generate():
+        for items in resource.batches(batch_size, fields):
+            lines = [dumps_bytes(item) + b"\n" for item in serialize(items, fields)]
+            yield b"".join(lines)
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+# many-to-one relationships are joined into the same SELECT, collections are
+# loaded with one extra "SELECT ... WHERE id IN (...)" per relationship
+people = ResourceQuery(Person, "person", [
+    joinedload(Person.homeworld),
+], {
+    "homeworld": joinedload(Person.homeworld).load_only(Planet.name),
+}, [Person.homeworld_id])
+
+planets = ResourceQuery(Planet, "planet")
+
+vehicles = ResourceQuery(Vehicle, "vehicle")
+
+users = ResourceQuery(User, "user", [
+    selectinload(User.people).joinedload(Person.homeworld),
+    selectinload(User.planets),
+    selectinload(User.vehicles),
+], {
+    "favorite_people": selectinload(User.people).joinedload(Person.homeworld),
+    "favorite_planets": selectinload(User.planets),
+    "favorite_vehicles": selectinload(User.vehicles),
+})
+
+# users without their favorites, used when favorites are returned as id lists
+users_summary = ResourceQuery(User, "user")
+
+
+# favorites key, junction table and junction column of each favorite type
+JUNCTIONS = [
+    ("people", favorite_people, favorite_people.c.person_id),
+    ("planets", favorite_planets, favorite_planets.c.planet_id),
+    ("vehicles", favorite_vehicles, favorite_vehicles.c.vehicle_id),
+]
+
+
+def favorite_ids_statement(table, column, user_ids):
+    return (
+        db.select(table.c.user_id, column)
+        .where(table.c.user_id.in_(user_ids))
+        .order_by(table.c.user_id, column)
+    )
+
+
+def favorite_ids(user_ids, session=None):
+    """
+    Loads the favorite ids of many users with one query per junction table,
+    returns {user_id: {"people": [...], "planets": [...], "vehicles": [...]}}.
+    session defaults to db.session, asgi.py passes the sync session of its
+    async one
+    """
+    if session is None:
+        session = db.session
+    result = {}
+    for user_id in user_ids:
+        result[user_id] = {"people": [], "planets": [], "vehicles": []}
+    if len(result) == 0:
+        return result
+
+    for key, table, column in JUNCTIONS:
+        rows = session.execute(favorite_ids_statement(table, column, list(result.keys())))
+        for user_id, resource_id in rows:
+            result[user_id][key].append(resource_id)
+    return result
+
+
+def favorites_as_ids():
+    # ?favorites=ids returns the favorites of users as id lists
+    favorites = request.args.get("favorites", "full")
+    if favorites not in ("full", "ids"):
+        raise APIException("favorites must be 'full' or 'ids'", status_code=400)
+    return favorites == "ids"
+
+
+def users_for_request():
+    if favorites_as_ids():
+        return users_summary
+    return users
+
+
+# Flask endpoint -> resource query, response key and msg of the read routes,
+# shared by main.py, the ASGI routes, the snapshot and /batch
+READ_ROUTES = {
+    "get_people": (people, "people", "These are characters"),
+    "get_person_by_id": (people, "person", "This is a character"),
+    "get_planets": (planets, "planets", "These are planets"),
+    "get_planet_by_id": (planets, "planet", "This is a planet"),
+    "get_vehicles": (vehicles, "vehicles", "These are vehicles"),
+    "get_vehicle_by_id": (vehicles, "vehicle", "This is a vehicle"),
+    "handle_users": (users, "users", "These are all users"),
+    "get_user_by_id": (users, "user", None),
+}
+
+# table -> collection and detail endpoints of the catalog
+CATALOG_ENDPOINTS = {
+    "people": ("get_people", "get_person_by_id"),
+    "planets": ("get_planets", "get_planet_by_id"),
+    "vehicles": ("get_vehicles", "get_vehicle_by_id"),
+}
+
+
+def route_resource(endpoint):
+    # the users routes load the favorites depending on ?favorites=
+    resource = READ_ROUTES[endpoint][0]
+    if resource is users:
+        return users_for_request()
+    return resource
+
+
+def read_route(endpoint):
+    # (resource, key, msg) of a read route for the current request
+    return (route_resource(endpoint),) + READ_ROUTES[endpoint][1:]
+
+
+def serialize_users(items, fields=None, session=None):
+    if not favorites_as_ids():
+        return serialize_items(items, fields)
+    ids = favorite_ids([user.id for user in items], session)
+    return list(map(lambda x:x.serialize(ids[x.id], fields), items))
@@ -0,0 +1,110 @@
+"""
+Read/write routing: when DB_REPLICA_CONNECTION_STRING is set, the reads of GET
+requests go to the replica and everything else (login, favorites, the admin,
+flushes) to the primary. A client that has just written reads from the primary
+for REPLICA_STICKY_SECONDS so it sees its own writes despite the replication
+lag: a browser through a cookie, a bearer client through its JWT identity.
+"""
+import time
+from flask import g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from utils import jwt_identity
+
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# endpoints that only read despite their method (POST /batch runs GETs)
+READ_ENDPOINTS = ("run_batch",)
+
+STICKY_COOKIE = "db_primary_until"
+
+# JWT identities that have just written, expire after REPLICA_STICKY_SECONDS.
+# Shared by the workers with the redis cache backend, else per worker: a
+# bearer client may then read from the replica on another worker. Set by
+# init_app when there is a replica
+sticky_identities = None
+
+# config key -> engine option and type, the options that are not set keep the
+# defaults of SQLAlchemy (some pools, like sqlite's in-memory one, refuse them)
+POOL_OPTIONS = {
+    "DB_POOL_SIZE": ("pool_size", int),
+    "DB_MAX_OVERFLOW": ("max_overflow", int),
+    "DB_POOL_TIMEOUT": ("pool_timeout", int),
+    "DB_POOL_RECYCLE": ("pool_recycle", int),
+    "DB_POOL_PRE_PING": ("pool_pre_ping", lambda value: value in (True, "true", "1")),
+}
+
+
+def is_read():
+    return request.method in READ_METHODS or request.endpoint in READ_ENDPOINTS
+
+
+def reads_from_replica():
+    # decided once per request, outside of a request (cli, background
+    # threads) the primary is used
+    if not has_request_context():
+        return False
+    if "db_replica" not in g:
+        g.db_replica = (
+            is_read()
+            and not request.path.startswith("/admin")
+            and not is_sticky()
+        )
+    return g.db_replica
+
+
+def is_sticky():
+    try:
+        until = float(request.cookies.get(STICKY_COOKIE, 0))
+    except ValueError:
+        until = 0
+    if until > time.time():
+        return True
+    identity = jwt_identity()
+    return identity is not None and sticky_identities is not None and sticky_identities.get(str(identity)) is not None
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and reads_from_replica():
+            replica = self._db.engines.get("replica")
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper, clause, bind, **kwargs)
+
+
+def init_app(app):
+    """
+    Sets the engine options and the replica bind, must be called before
+    db.init_app
+    """
+    options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+    for key, (option, convert) in POOL_OPTIONS.items():
+        if app.config.get(key) not in (None, ""):
+            options[option] = convert(app.config[key])
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+
+    replica = app.config.get("DB_REPLICA_CONNECTION_STRING")
+    if not replica:
+        return
+    binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+    # binds don't inherit SQLALCHEMY_ENGINE_OPTIONS
+    binds["replica"] = dict(options, url=replica)
+    app.config["SQLALCHEMY_BINDS"] = binds
+
+    # imported here, cache imports models which imports this module
+    from cache import MemoryBackend, RedisBackend
+    global sticky_identities
+    seconds = app.config["REPLICA_STICKY_SECONDS"]
+    if app.config.get("CACHE_BACKEND") == "redis":
+        sticky_identities = RedisBackend(app.config["CACHE_REDIS_URL"], seconds, namespace="starwars:sticky:")
+    else:
+        sticky_identities = MemoryBackend(ttl=seconds)
+
+    @app.after_request
+    def stick_to_primary(response):
+        if not is_read() and response.status_code < 400:
+            response.set_cookie(STICKY_COOKIE, str(time.time() + seconds), max_age=seconds, httponly=True)
+            identity = jwt_identity()
+            if identity is not None:
+                sticky_identities.set(str(identity), True)
+        return response
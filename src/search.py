@@ -0,0 +1,245 @@
+"""
+Full-text search over the name and description of people, planets and
+vehicles. Each worker keeps an inverted index in memory: it is built on the
+first search and updated incrementally, with the rows written by this worker
+and, when the table versions show that another process wrote to the catalog,
+with the rows of the change log since the index was last updated. After a
+large write (more than CATCH_UP_LIMIT changes) it is rebuilt in a background
+thread while the searches keep using the current index. A search only reads
+the postings of the words in the query, so its cost depends on how many rows
+match and not on the size of the catalog.
+"""
+import math
+import re
+import threading
+from collections import Counter
+from flask import url_for
+from utils import listen_once
+from models import db, Change, Person, Planet, Vehicle
+import versions
+
+# model, type and detail endpoint of each table
+MODELS = {
+    "people": (Person, "person", "get_person_by_id"),
+    "planets": (Planet, "planet", "get_planet_by_id"),
+    "vehicles": (Vehicle, "vehicle", "get_vehicle_by_id"),
+}
+
+# a word of the name counts as much as this many words of the description
+NAME_WEIGHT = 3
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# changes of other processes applied during a search, past that the index is
+# rebuilt in the background
+CATCH_UP_LIMIT = 1000
+
+WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    if not text:
+        return []
+    return WORD.findall(text.lower())
+
+
+class SearchIndex:
+    def __init__(self):
+        self.postings = {}
+        self.documents = {}
+        self.total_length = 0
+        # table versions the index reflects, None until it is built
+        self.versions = None
+        # last seq of the change log the index reflects
+        self.seq = 0
+        self.lock = threading.RLock()
+        self.rebuilding = False
+
+    def init_app(self, app):
+        self.app = app
+        listen_once(db.session, "after_flush", self.after_flush)
+        listen_once(db.session, "after_commit", self.after_commit)
+        listen_once(db.session, "after_rollback", self.after_rollback)
+
+    def add(self, key, name, description):
+        self.remove(key)
+        terms = Counter()
+        for word in tokenize(name):
+            terms[word] += NAME_WEIGHT
+        for word in tokenize(description):
+            terms[word] += 1
+        length = sum(terms.values())
+        self.documents[key] = (name, length, list(terms))
+        self.total_length += length
+        for word, frequency in terms.items():
+            self.postings.setdefault(word, {})[key] = frequency
+
+    def remove(self, key):
+        document = self.documents.pop(key, None)
+        if document is None:
+            return
+        name, length, words = document
+        self.total_length -= length
+        for word in words:
+            postings = self.postings.get(word)
+            postings.pop(key, None)
+            if len(postings) == 0:
+                del self.postings[word]
+
+    def table_versions(self):
+        current = versions.current_versions(list(MODELS))
+        return {name: current.get(name, (0, None))[0] for name in MODELS}
+
+    def build(self):
+        """
+        Loads every row into a new index and swaps it in, the searches use the
+        current one meanwhile
+        """
+        fresh = SearchIndex()
+        # read before the rows, the changes committed in between are applied
+        # again by the next catch_up
+        fresh.versions = self.table_versions()
+        fresh.seq = db.session.execute(db.select(db.func.max(Change.seq))).scalar() or 0
+        for table, (model, type_name, endpoint) in MODELS.items():
+            rows = db.session.execute(
+                db.select(model.id, model.name, model.description)
+                .execution_options(yield_per=1000)
+            )
+            for id, name, description in rows:
+                fresh.add((table, id), name, description)
+        with self.lock:
+            self.postings = fresh.postings
+            self.documents = fresh.documents
+            self.total_length = fresh.total_length
+            self.versions = fresh.versions
+            self.seq = fresh.seq
+
+    def rebuild_in_background(self):
+        if self.rebuilding:
+            return
+        self.rebuilding = True
+
+        def run():
+            try:
+                with self.app.app_context():
+                    self.build()
+            finally:
+                self.rebuilding = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def catch_up(self, current):
+        """
+        Applies the changes logged since self.seq, returns False when there are
+        too many to apply during a search
+        """
+        rows = db.session.execute(
+            db.select(Change.seq, Change.table_name, Change.row_id)
+            .where(Change.seq > self.seq, Change.table_name.in_(list(MODELS)))
+            .order_by(Change.seq)
+            .limit(CATCH_UP_LIMIT + 1)
+        ).all()
+        if len(rows) > CATCH_UP_LIMIT:
+            return False
+        ids = {}
+        for seq, table, id in rows:
+            ids.setdefault(table, set()).add(id)
+        for table, table_ids in ids.items():
+            model = MODELS[table][0]
+            found = db.session.execute(
+                db.select(model.id, model.name, model.description).where(model.id.in_(table_ids))
+            )
+            for id, name, description in found:
+                self.add((table, id), name, description)
+                table_ids.discard(id)
+            # the rows that are gone were deleted
+            for id in table_ids:
+                self.remove((table, id))
+        if len(rows) > 0:
+            self.seq = rows[-1][0]
+        self.versions = current
+        return True
+
+    def ensure_current(self):
+        # the versions are read before the changes, a change committed in
+        # between is applied again on the next search
+        current = self.table_versions()
+        if self.versions is None:
+            self.build()
+        elif self.versions != current and not self.rebuilding and not self.catch_up(current):
+            self.rebuild_in_background()
+
+    def search(self, query):
+        """
+        Returns the (score, table, id, name) of the rows matching any word of
+        the query, best first, ranked with BM25
+        """
+        with self.lock:
+            self.ensure_current()
+            count = len(self.documents)
+            if count == 0:
+                return []
+            average_length = self.total_length / count
+            scores = Counter()
+            for word in set(tokenize(query)):
+                postings = self.postings.get(word)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for key, frequency in postings.items():
+                    length = self.documents[key][1]
+                    scores[key] += idf * frequency * (K1 + 1) / (frequency + K1 * (1 - B + B * length / average_length))
+            results = [(score, key[0], key[1], self.documents[key][0]) for key, score in scores.items()]
+        results.sort(key=lambda x: (-x[0], x[1], x[2]))
+        return results
+
+    def serialize_result(self, result):
+        score, table, id, name = result
+        model, type_name, endpoint = MODELS[table]
+        return {
+            "type": type_name,
+            "id": id,
+            "name": name,
+            "score": round(score, 4),
+            "url": url_for(endpoint, id=id)
+        }
+
+    # incremental updates with the rows written by this process: the values
+    # are captured on flush and applied once the transaction commits
+    def after_flush(self, session, flush_context):
+        pending = session.info.setdefault("search_pending", {"changes": [], "bumps": Counter()})
+        tables = set()
+        for obj in list(session.new) + list(session.dirty):
+            if isinstance(obj, (Person, Planet, Vehicle)):
+                pending["changes"].append(((obj.__tablename__, obj.id), obj.name, obj.description))
+                tables.add(obj.__tablename__)
+        for obj in session.deleted:
+            if isinstance(obj, (Person, Planet, Vehicle)):
+                pending["changes"].append(((obj.__tablename__, obj.id), None, None))
+                tables.add(obj.__tablename__)
+        # versions.after_flush bumps each written table by one per flush
+        for table in tables:
+            pending["bumps"][table] += 1
+
+    def after_commit(self, session):
+        pending = session.info.pop("search_pending", None)
+        if pending is None:
+            return
+        with self.lock:
+            if self.versions is None:
+                return
+            for key, name, description in pending["changes"]:
+                if name is None:
+                    self.remove(key)
+                else:
+                    self.add(key, name, description)
+            for table, bumps in pending["bumps"].items():
+                self.versions[table] += bumps
+
+    def after_rollback(self, session):
+        session.info.pop("search_pending", None)
+
+
+search_index = SearchIndex()
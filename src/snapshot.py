@@ -0,0 +1,222 @@
+"""
+Pre-serialized snapshot of the catalog (people, planets and vehicles) shared by
+all the gunicorn workers: the JSON bodies of the collection and detail routes
+are written once to a file that every worker maps in memory, requests are
+answered with slices of that mapping without touching the database.
+
+File layout:
+    MAGIC, uint32 length of the header, header (JSON), bodies, indexes
+The header holds the table versions the snapshot was built from, the position
+of the collection bodies and the position of each table index, relative to the
+end of the header. An index is a sorted array of (id, offset, length) uint64
+triplets searched in place.
+"""
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+import click
+from functools import wraps
+from flask import Response, current_app, g, request
+import queries
+import versions
+
+MAGIC = b"SWSNAP1\n"
+ENTRY = struct.Struct("<QQQ")
+
+TABLES = tuple(queries.CATALOG_ENDPOINTS)
+
+
+class Snapshot:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime_ns)
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError(path + " is not a catalog snapshot")
+        start = len(MAGIC) + 4
+        (header_length,) = struct.unpack_from("<I", self.data, len(MAGIC))
+        header = json.loads(self.data[start:start + header_length])
+        self.base = start + header_length
+        self.versions = header["versions"]
+        self.collections = header["collections"]
+        self.indexes = header["indexes"]
+
+    def slice(self, offset, length):
+        offset += self.base
+        return memoryview(self.data)[offset:offset + length]
+
+    def collection(self, table):
+        position = self.collections.get(table)
+        if position is None:
+            return None
+        return self.slice(*position)
+
+    def detail(self, table, id):
+        index_offset, count = self.indexes[table]
+        index_offset += self.base
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            entry_id, offset, length = ENTRY.unpack_from(self.data, index_offset + middle * ENTRY.size)
+            if entry_id == id:
+                return self.slice(offset, length)
+            if entry_id < id:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+
+def build(path):
+    """
+    Writes a new snapshot next to path and atomically renames it over the
+    previous one, must run inside an app context
+    """
+    app = current_app._get_current_object()
+    current = versions.current_versions(TABLES)
+    header = {
+        "versions": {name: current.get(name, (0, None))[0] for name in TABLES},
+        "collections": {},
+        "indexes": {},
+    }
+    batch_size = app.config["EXPORT_BATCH_SIZE"]
+    bodies = bytearray()
+    index = {}
+
+    # the collection bodies are produced by the routes themselves
+    for table, (endpoint, detail) in queries.CATALOG_ENDPOINTS.items():
+        with app.test_request_context("/" + table):
+            g.snapshot_build = True
+            response = current_app.make_response(current_app.view_functions[endpoint]())
+            body = response.get_data()
+        header["collections"][table] = [len(bodies), len(body)]
+        bodies += body
+
+    for table, (collection, endpoint) in queries.CATALOG_ENDPOINTS.items():
+        resource, key, msg = queries.READ_ROUTES[endpoint]
+        entries = []
+        for items in resource.batches(batch_size):
+            for item in items:
+                body = app.json.response({"msg": msg, key: item.serialize()}).get_data()
+                entries.append((item.id, len(bodies), len(body)))
+                bodies += body
+        index[table] = entries
+
+    offset = len(bodies)
+    for table, entries in index.items():
+        header["indexes"][table] = [offset, len(entries)]
+        offset += ENTRY.size * len(entries)
+    encoded = json.dumps(header).encode("utf-8")
+
+    temporary = path + ".tmp" + str(os.getpid())
+    with open(temporary, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(encoded)))
+        f.write(encoded)
+        f.write(bodies)
+        for table, entries in index.items():
+            for entry_id, offset, length in entries:
+                f.write(ENTRY.pack(entry_id, offset, length))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+class SnapshotStore:
+    def __init__(self):
+        self.path = None
+        self.snapshot = None
+        self.lock = threading.Lock()
+        self.rebuilding = False
+
+    def init_app(self, app):
+        self.path = app.config.get("SNAPSHOT_PATH")
+        self.auto_rebuild = app.config.get("SNAPSHOT_AUTO_REBUILD", True)
+        self.app = app
+
+        @app.cli.command("build-snapshot")
+        def build_snapshot():
+            """Writes the catalog snapshot to SNAPSHOT_PATH"""
+            if self.path is None:
+                raise click.ClickException("SNAPSHOT_PATH is not set")
+            build(self.path)
+
+    def current(self):
+        # workers notice a rebuilt file by its inode/mtime and map it again,
+        # the previous mapping is released once no response uses it anymore
+        if self.path is None:
+            return None
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        snapshot = self.snapshot
+        if snapshot is None or snapshot.identity != (stat.st_ino, stat.st_mtime_ns):
+            with self.lock:
+                try:
+                    self.snapshot = snapshot = Snapshot(self.path)
+                except (OSError, ValueError):
+                    return None
+        return snapshot
+
+    def rebuild_in_background(self):
+        # one worker of the host rebuilds, the others keep querying meanwhile
+        if self.path is None or not self.auto_rebuild or self.rebuilding:
+            return
+        self.rebuilding = True
+
+        def run():
+            try:
+                with open(self.path + ".lock", "w") as lock:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        return
+                    with self.app.app_context():
+                        build(self.path)
+            finally:
+                self.rebuilding = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def is_current(self, snapshot):
+        # g.table_versions is set by versions.conditional for this request
+        table_versions = g.get("table_versions", {})
+        for name, (version, updated_at) in table_versions.items():
+            if snapshot.versions.get(name) != version:
+                return False
+        return True
+
+
+store = SnapshotStore()
+
+
+def serve(table):
+    """
+    Decorator for the collection and detail routes of people, planets and
+    vehicles, must be placed under versions.conditional
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.args or g.get("snapshot_build"):
+                return view(*args, **kwargs)
+            snapshot = store.current()
+            if snapshot is None or not store.is_current(snapshot):
+                store.rebuild_in_background()
+                return view(*args, **kwargs)
+            if "id" in kwargs:
+                body = snapshot.detail(table, kwargs["id"])
+            else:
+                body = snapshot.collection(table)
+            if body is None:
+                return view(*args, **kwargs)
+            response = Response([body], mimetype=current_app.json.mimetype, direct_passthrough=True)
+            response.content_length = len(body)
+            return response
+        return wrapper
+    return decorator
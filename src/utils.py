@@ -1,4 +1,6 @@
-from flask import jsonify, url_for
+from flask import current_app, jsonify, request, url_for
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from sqlalchemy import event
 
 class APIException(Exception):
     status_code = 400
@@ -15,6 +17,26 @@ class APIException(Exception):
         rv['message'] = self.message
         return rv
 
+    def to_response(self):
+        # encoded with the app's JSON backend, see encoders.py
+        return current_app.json.response(self.to_dict()), self.status_code
+
+def listen_once(target, identifier, fn):
+    # the listeners on db.session are global, init_app may run for several apps
+    if not event.contains(target, identifier, fn):
+        event.listen(target, identifier, fn)
+
+def jwt_identity():
+    # the identity of the request's bearer token, None without a valid one
+    if not request.headers.get("Authorization", "").startswith("Bearer "):
+        return None
+    try:
+        verify_jwt_in_request(optional=True)
+        return get_jwt_identity()
+    except Exception:
+        # an invalid token is refused by the route itself
+        return None
+
 def has_no_empty_params(rule):
     defaults = rule.defaults if rule.defaults is not None else ()
     arguments = rule.arguments if rule.arguments is not None else ()
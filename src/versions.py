@@ -0,0 +1,159 @@
+"""
+Conditional GETs: every table has a version number that is bumped in the same
+transaction as any write to it, the ETag and Last-Modified of a response are
+derived from the versions of the tables it reads. Answering a 304 only costs
+one small SELECT on table_versions, no rows are loaded or serialized.
+"""
+import hashlib
+from datetime import datetime, timezone
+from functools import wraps
+from flask import g, has_request_context, make_response, request
+from utils import listen_once
+from models import db, TableVersion, User, Person, Planet, Vehicle
+
+VERSIONED_MODELS = (User, Person, Planet, Vehicle)
+
+MODELS = {model.__tablename__: model for model in VERSIONED_MODELS}
+
+# the tables each resource reads when it is serialized
+DEPENDENCIES = {
+    "people": ("people", "planets"),
+    "planets": ("planets",),
+    "vehicles": ("vehicles",),
+    "users": ("users", "people", "planets", "vehicles"),
+}
+
+
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def bump(connection, names):
+    table = TableVersion.__table__
+    now = utcnow()
+    for name in sorted(names):
+        result = connection.execute(
+            table.update()
+            .where(table.c.name == name)
+            .values(version=table.c.version + 1, updated_at=now)
+        )
+        if result.rowcount == 0:
+            connection.execute(table.insert().values(name=name, version=1, updated_at=now))
+
+
+def after_flush(session, flush_context):
+    names = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, VERSIONED_MODELS):
+            names.add(obj.__tablename__)
+    if len(names) > 0:
+        bump(session.connection(), names)
+
+
+def init_app(app):
+    listen_once(db.session, "after_flush", after_flush)
+
+
+def versions_statement(names):
+    return (
+        db.select(TableVersion.name, TableVersion.version, TableVersion.updated_at)
+        .where(TableVersion.name.in_(names))
+    )
+
+
+def versions_from_rows(rows):
+    versions = {}
+    for name, version, updated_at in rows:
+        versions[name] = (version, updated_at)
+    return versions
+
+
+def current_versions(names):
+    return versions_from_rows(db.session.execute(versions_statement(names)))
+
+
+def request_versions(names):
+    """
+    The versions of names, the ones versions.conditional has read for this
+    request when it has read them all
+    """
+    versions = g.get("table_versions") if has_request_context() else None
+    if versions is None or any(name not in versions for name in names):
+        versions = current_versions(names)
+    return versions
+
+
+def cache_version(table):
+    """
+    The versions of the tables a cached row of table is serialized from, the
+    entity cache only returns entries stored with the same ones
+    """
+    versions = request_versions(DEPENDENCIES[table])
+    return tuple(versions.get(name, (0, None))[0] for name in DEPENDENCIES[table])
+
+
+def resource_tables(resource, extra_tables=None):
+    # extra_tables(model) returns the other tables the request reads, see
+    # includes.tables
+    names = DEPENDENCIES[resource]
+    if extra_tables is not None:
+        names += tuple(sorted(extra_tables(MODELS[resource]) - set(names)))
+    return names
+
+
+def validators(names, versions):
+    """
+    The strong ETag and the Last-Modified of the current request when it
+    reads the tables names, at versions
+    """
+    key = request.full_path + "|" + ",".join(
+        name + "=" + str(versions.get(name, (0, None))[0]) for name in names
+    )
+    etag = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    timestamps = [updated_at for version, updated_at in versions.values()]
+    last_modified = None
+    if len(timestamps) > 0:
+        last_modified = max(timestamps).replace(microsecond=0, tzinfo=timezone.utc)
+    return etag, last_modified
+
+
+def is_not_modified(etag, last_modified):
+    if request.if_none_match:
+        # weak comparison, compression.py makes the ETag of compressed
+        # responses weak
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified is not None:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def set_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+def conditional(resource, extra_tables=None):
+    """
+    Decorator for the GET routes of a resource: adds a strong ETag and a
+    Last-Modified header, and answers 304 without calling the route when the
+    client already has the current version. asgi.py does the same for its
+    async routes
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            names = resource_tables(resource, extra_tables)
+            versions = current_versions(names)
+            g.table_versions = versions
+            etag, last_modified = validators(names, versions)
+            if is_not_modified(etag, last_modified):
+                response = make_response("", 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            return set_validators(response, etag, last_modified)
+        return wrapper
+    return decorator
@@ -1,7 +1,10 @@
 # This file was created to run the application on heroku using gunicorn.
 # Read more about it here: https://devcenter.heroku.com/articles/python-gunicorn
 
-from main import app as application
+from main import create_app
+
+# ENABLE_ADMIN, ENABLE_MIGRATE and ENABLE_SWAGGER=false give API-only workers
+application = create_app()
 
 if __name__ == "__main__":
     application.run()
@@ -0,0 +1,41 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+
+def seed(n):
+    """
+    n planets, people, vehicles and users, each user with a few favorites
+    """
+    from models import db, User, Person, Planet, Vehicle
+    db.create_all()
+    planets = [Planet(name="Planet %d" % i, population="1,000", diameter=str(1000 + i)) for i in range(n)]
+    people = [Person(name="Person %d" % i, mass=str(50 + i), height="unknown", homeworld=planets[i]) for i in range(n)]
+    vehicles = [Vehicle(name="Vehicle %d" % i, model="m", crew=str(i)) for i in range(n)]
+    users = [
+        User(
+            name="u%d" % i, username="u%d" % i, email="u%d@x" % i, password="p", is_active=True,
+            people=people[:i % 5], planets=planets[:3], vehicles=vehicles[:2]
+        )
+        for i in range(n)
+    ]
+    db.session.add_all(planets + people + vehicles + users)
+    db.session.commit()
+
+
+@pytest.fixture
+def make_app(tmp_path, monkeypatch):
+    """
+    make_app(n) returns an app on a new sqlite database seeded with n rows
+    per table
+    """
+    def make(n):
+        monkeypatch.setenv("DB_CONNECTION_STRING", "sqlite:///" + str(tmp_path / ("%d.db" % n)))
+        from main import create_app
+        app = create_app(admin=False, migrate=False, swagger=False)
+        with app.app_context():
+            seed(n)
+        return app
+    return make
@@ -0,0 +1,65 @@
+import os
+import asyncio
+import pytest
+from conftest import seed
+
+pytest.importorskip("aiosqlite")
+
+PATHS = [
+    "/people", "/people?limit=3&sort=-mass", "/people/1", "/people/999", "/people/1?fields=name,homeworld",
+    "/planets?fields=name,population", "/planets/2", "/vehicles", "/vehicles/3",
+    "/users", "/users?favorites=ids", "/users/2", "/users/2?favorites=ids&fields=name,favorite_planets",
+    "/people?limit=0", "/people?cursor=zz",
+]
+
+
+@pytest.fixture(scope="module")
+def asgi(tmp_path_factory):
+    # asgi.py builds its app when it is imported
+    os.environ["DB_CONNECTION_STRING"] = "sqlite:///" + str(tmp_path_factory.mktemp("asgi") / "asgi.db")
+    import asgi
+    with asgi.app.app_context():
+        seed(10)
+    return asgi
+
+
+def call(asgi, path, headers=()):
+    path, separator, query = path.partition("?")
+    scope = {
+        "type": "http", "method": "GET", "path": path, "query_string": query.encode(), "root_path": "",
+        "headers": [(b"host", b"localhost")] + list(headers), "http_version": "1.1", "scheme": "http",
+        "server": ("localhost", 80),
+    }
+    response = {"body": b""}
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {name.decode(): value.decode() for name, value in message["headers"]}
+        else:
+            response["body"] += message.get("body", b"")
+
+    asyncio.run(asgi.application(scope, receive, send))
+    return response
+
+
+@pytest.mark.parametrize("path", PATHS)
+def test_same_response_as_flask(asgi, path):
+    expected = asgi.app.test_client().get(path)
+    response = call(asgi, path)
+    assert response["status"] == expected.status_code
+    assert response["body"] == expected.data
+    assert response["headers"].get("etag") == expected.headers.get("ETag")
+    assert response["headers"].get("last-modified") == expected.headers.get("Last-Modified")
+    assert ("server-timing" in response["headers"]) == ("Server-Timing" in expected.headers)
+
+
+@pytest.mark.parametrize("path", ["/people", "/people/1", "/users?favorites=ids"])
+def test_not_modified(asgi, path):
+    etag = call(asgi, path)["headers"]["etag"]
+    response = call(asgi, path, [(b"if-none-match", etag.encode())])
+    assert response["status"] == 304
+    assert response["body"] == b""
@@ -0,0 +1,19 @@
+import json
+import pytest
+
+
+@pytest.fixture
+def client(make_app):
+    return make_app(5).test_client()
+
+
+def test_batch_is_json(client):
+    paths = ["/people/1", "/people?limit=2", "/people/99", "/", "/metrics", "/people/export"]
+    response = client.post("/batch", json={"requests": paths})
+    assert response.status_code == 200
+    responses = json.loads(response.data)["responses"]
+    assert [item["path"] for item in responses] == paths
+    assert [item["status"] for item in responses] == [200, 200, 404, 400, 400, 400]
+    assert responses[0]["body"]["person"]["id"] == 1
+    for item in responses[3:]:
+        assert item["body"] == {"message": "Only JSON routes can be batched"}
@@ -0,0 +1,26 @@
+import pytest
+
+
+@pytest.fixture
+def client(make_app):
+    return make_app(50).test_client()
+
+
+@pytest.mark.parametrize("path", ["/people", "/people/1"])
+def test_etag_is_weak_on_the_200_and_the_304(client, path):
+    # /people is compressed, /people/1 is too small to be
+    headers = {"Accept-Encoding": "gzip"}
+    response = client.get(path, headers=headers)
+    etag = response.headers["ETag"]
+    assert etag.startswith('W/"')
+    response = client.get(path, headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+
+def test_etag_is_strong_without_encoding(client):
+    etag = client.get("/people").headers["ETag"]
+    assert etag.startswith('"')
+    response = client.get("/people", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
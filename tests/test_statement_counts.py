@@ -0,0 +1,29 @@
+from sqlalchemy import event
+from models import db
+
+N = 10
+
+# the routes must not issue more queries for a bigger catalog
+PATHS = [
+    "/people", "/people/1", "/planets", "/planets/1", "/vehicles", "/vehicles/1",
+    "/users", "/users?favorites=ids", "/users/1", "/users/1?favorites=ids",
+]
+
+
+def statement_counts(app):
+    statements = []
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    client = app.test_client()
+    counts = {}
+    for path in PATHS:
+        statements.clear()
+        response = client.get(path)
+        assert response.status_code == 200, path
+        counts[path] = len(statements)
+    return counts
+
+
+def test_statement_count_does_not_grow_with_rows(make_app):
+    # the collections are not paginated by default, they return every row
+    assert statement_counts(make_app(N)) == statement_counts(make_app(2 * N))